@@ -1,6 +1,5 @@
 import re, sys, argparse
-from functools import reduce
-from lark import Lark
+from lark import Lark, Token
 from program import Program
 
 
@@ -54,6 +53,15 @@ class Assembler:
         "random_int": 0xE5,
         "get_pixel": 0xE6,
         "set_all_pixels": 0xE7,
+        "fill_pixels": 0xE8,
+        "shift_pixels": 0xE9,
+        "rotate_pixels": 0xEA,
+        "blend_pixels": 0xEB,
+        "hue_gradient": 0xEC,
+        "PEEK_PIXEL": 0xA0,
+        "SLEEP_JMP": 0xB0,
+        "SUB_LENGTH_JNZ": 0xC0,
+        "ADD_MUL_FLOOR": 0xD0,
         "sleep": 0xF9,
         "exit": 0xFA,
         "error": 0xFB,
@@ -63,7 +71,7 @@ class Assembler:
         "two_byte": 0xFF,
     }
 
-    FUNCT = {"POP", "PEEK"}  # instructions that use funct [5:8]
+    FUNCT = {"POP", "PEEK", "PEEK_PIXEL"}  # instructions that use funct [5:8]
 
     ARGS = {
         "PUSHB": [1],
@@ -71,29 +79,129 @@ class Assembler:
         "JMP": [2],
         "JZ": [2],
         "JNZ": [2],
+        "SLEEP_JMP": [1, 2],
+        "SUB_LENGTH_JNZ": [2],
+        "ADD_MUL_FLOOR": [1, 1],
     }
 
+    JUMPS = {"JMP", "JZ", "JNZ", "SLEEP_JMP", "SUB_LENGTH_JNZ"}  # last argument is an address
+
+    # sequences that are assembled into a single fused instruction, as
+    # (instruction, argument) pairs; the argument is None for none, a number
+    # it must equal, or "funct", "byte" or "label" for one that is passed on
+    # to the fused instruction
+    FUSIONS = {
+        "PEEK_PIXEL": [("PEEK", "funct"), ("get_pixel", None)],
+        "SLEEP_JMP": [("PUSHB", "byte"), ("sleep", None), ("JMP", "label")],
+        "SUB_LENGTH_JNZ": [("PEEK", 0), ("get_length", None), ("SUB", None), ("JNZ", "label")],
+        "ADD_MUL_FLOOR": [
+            ("PUSHB", "byte"), ("ADD", None), ("PUSHB", "byte"), ("MUL", None), ("FLOOR", None)
+        ],
+    }
+
+    # the whole source is parsed in one pass; instructions and labels are
+    # both CNAMEs, so they are told apart by the grammar and renamed after
     parser = Lark(
-        "%import common.WS\n"
-        "%ignore WS\n"
         "%import common.SH_COMMENT\n"
+        "%import common.CNAME -> NAME\n"
+        "%ignore /[ \\t\\f\\r]+/\n"
         "%ignore SH_COMMENT\n"
-        "%import common.INT -> DEC\n"
-        "%import common.CNAME\n"
         'INT : ("+"|"-")? (/[0-9]+/ | /0[bB][01]+/ | /0[oO][0-7]+/ | /0[xX][0-9a-fA-F]+/)\n'
-        "LABEL : CNAME\n"
-        "INST : CNAME\n"
-        'line : (LABEL ":")? (INST (INT | LABEL)? ("," (INT | LABEL))*)?',
-        start="line",
+        "_NL : /\\n+/\n"
+        "start : (line? _NL)* line?\n"
+        "line : label instruction? | instruction\n"
+        'label : NAME ":"\n'
+        'instruction : NAME (_arg ("," _arg)*)?\n'
+        "_arg : INT | NAME\n",
+        parser="lalr",
+        cache=True,  # reuse the built parser between runs
     )
 
+    # list of statements, each a LABEL token or an INST token followed by
+    # its argument (INT or LABEL) tokens
+    @staticmethod
+    def parse(source):
+        statements = []
+        for line in Assembler.parser.parse(source).children:
+            for part in line.children:
+                name, *args = part.children
+                if part.data == "label":
+                    statements.append([name.update(type="LABEL")])
+                    continue
+                statements.append([name.update(type="INST")] + [
+                    arg.update(type="LABEL") if arg.type == "NAME" else arg for arg in args
+                ])
+        return statements
+
+    # whether statement is instruction with an argument matching kind
+    @staticmethod
+    def matches(statement, instruction, kind):
+        token, *args = statement
+        if token.type != "INST" or token.value != instruction:
+            return False
+        if kind is None:
+            return not args
+        if len(args) != 1:
+            return False
+        if kind == "label":
+            return args[0].type == "LABEL"
+        if args[0].type != "INT":
+            return False
+        value = int(args[0], 0)
+        if kind == "funct":
+            return 0 <= value <= 0xf
+        if kind == "byte":
+            return 0 <= value <= 0xff
+        return value == kind
+
+    # replace the sequences in FUSIONS by their fused instruction; nothing is
+    # fused across a label, and nothing at all if an address is given as a
+    # number, since it would refer to the unfused layout
+    @staticmethod
+    def fuse(statements):
+        for token, *args in statements:
+            if token.value in Assembler.JUMPS and args and args[-1].type == "INT":
+                return statements
+        fused = []
+        i = 0
+        while i < len(statements):
+            for name, pattern in Assembler.FUSIONS.items():
+                window = statements[i : i + len(pattern)]
+                if len(window) == len(pattern) and all(
+                    Assembler.matches(statement, instruction, kind)
+                    for statement, (instruction, kind) in zip(window, pattern)
+                ):
+                    args = [
+                        statement[1]
+                        for statement, (instruction, kind) in zip(window, pattern)
+                        if isinstance(kind, str)
+                    ]
+                    fused.append([Token.new_borrow_pos("INST", name, window[0][0])] + args)
+                    i += len(pattern)
+                    break
+            else:
+                fused.append(statements[i])
+                i += 1
+        return fused
+
+    # flat list of LABEL, INST and argument (INT or LABEL) tokens
+    @staticmethod
+    def tokenize(source, fuse=True):
+        statements = Assembler.parse(source)
+        if fuse:
+            statements = Assembler.fuse(statements)
+        return [token for statement in statements for token in statement]
+
+    @staticmethod
+    def assemble(source, fuse=True):
+        return Assembler.assemble_mapped(source, fuse)[0]
+
+    # assemble source, also returning a source map with the line number
+    # (counted from 1) of every instruction and the address of every label:
+    # {"lines": {pc: line}, "labels": {label: pc}}
     @staticmethod
-    def assemble(source):
-        tokens = reduce(
-            lambda tokens, tree: tokens + (tree.children),
-            map(Assembler.parser.parse, source.split("\n")),
-            list(),
-        )  # use lark to parse source string
+    def assemble_mapped(source, fuse=True):
+        tokens = Assembler.tokenize(source, fuse)  # use lark to parse source string
 
         pointer = 0  # pointer to byte index
         labels = dict(
@@ -103,6 +211,7 @@ class Assembler:
             )
         )  # map from label to index
         jumps = dict()
+        lines = dict()  # map from instruction index to source line
         data = bytearray()
 
         iterator = iter(tokens)
@@ -121,6 +230,7 @@ class Assembler:
                             f"Expected argument for {token.value} instruction."
                         )
                     opcode += int(funct, 0)
+                lines[pointer] = token.line
                 data += bytes([opcode])
                 pointer += 1
                 if token.value in Assembler.ARGS:
@@ -161,18 +271,20 @@ class Assembler:
             addr = labels[label]
             data[jump : jump + 2] = addr.to_bytes(2, "little")
 
-        return data
+        return data, {"lines": lines, "labels": labels}
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("infile", default=None, metavar="file", type=str)
     parser.add_argument("-o", type=str, metavar="file", dest="outfile")
+    parser.add_argument("--no-fuse", action="store_false", dest="fuse",
+                        help="do not use fused instructions")
     args = parser.parse_args()
 
     with open(args.infile, "r") as sourcefile:
         source = sourcefile.read()
-    binary = Assembler.assemble(source)
+    binary = Assembler.assemble(source, args.fuse)
     if args.outfile:
         with open(args.outfile, "wb") as progfile:
             progfile.write(binary)
@@ -0,0 +1,209 @@
+import argparse, json, os, platform, tempfile
+from datetime import datetime, timezone
+from statistics import mean, median
+from time import perf_counter, sleep
+
+from assembler import Assembler
+from engines import ENGINES
+from pixels import Pixels, VirtualBackend
+
+# Benchmarks for the VM engines, the assembler, program switching and frame
+# output. Everything runs against the virtual backend, so no hardware is
+# needed; results are written as JSON for comparison between releases.
+
+STRIP_LENGTH = 150
+
+# counts down from 2**20 through a mix of arithmetic, without touching pixels
+ARITHMETIC_SOURCE = """
+  PUSHW 0x100000     # [n]
+loop:
+  PEEK 0             # [n, n]
+  PUSHB 3
+  MUL
+  PUSHB 7
+  ADD
+  PUSHB 0xff
+  AND
+  PEEK 1
+  XOR
+  PUSHW 1000
+  MOD                # [x, n]
+  POP 1              # [n]
+  DEC                # [n-1]
+  JNZ loop
+  exit
+"""
+
+
+def programs():
+    binaries = {}
+    for name in ("life", "rainbow"):
+        with open(f"programs/{name}.bin", "rb") as binary:
+            binaries[name] = binary.read()
+        # the same program without fused instructions, for comparison
+        with open(f"programs/{name}.asm") as source:
+            binaries[f"{name}_unfused"] = bytes(Assembler.assemble(source.read(), fuse=False))
+    binaries["arithmetic"] = bytes(Assembler.assemble(ARITHMETIC_SOURCE))
+    return binaries
+
+
+# instructions and slices per second executing data, leaving out time spent
+# sleeping; a slice ends at every sleep, so for programs that sleep once per
+# frame slices are frames, which stay comparable when fused instructions
+# change the instruction count
+def bench_engine(engine, data, seconds):
+    program = engine("bench", data, pixels=Pixels(STRIP_LENGTH, VirtualBackend()))
+    executed = slices = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        if not program.running:
+            program.load("bench", data)
+        executed += program.run_slice()
+        slices += 1
+        program.wake_time = 0.0
+    elapsed = perf_counter() - start
+    return {"instructions": executed, "slices": slices, "seconds": elapsed,
+            "per_second": executed / elapsed, "slices_per_second": slices / elapsed}
+
+
+def bench_engines(names, seconds):
+    binaries = programs()
+    return {
+        name: {
+            program: bench_engine(ENGINES[name], data, seconds)
+            for program, data in binaries.items()
+        }
+        for name in names
+    }
+
+
+# source of roughly the given number of lines, with a label every 16 lines
+def generate_source(lines):
+    body = []
+    for i in range(lines // 16):
+        body.append(f"label_{i}:")
+        body.append("  PUSHW 0x404040")
+        body.append("  PUSHB 25")
+        body.append("  PEEK 1")
+        body.append("  set_pixel  # comment")
+        body.append("  POP 1")
+        body.append("  get_length")
+        body.append("  MOD")
+        body.append("  PUSHB 0x7f")
+        body.append("  MUL")
+        body.append("  FLOOR")
+        body.append(f"  JZ label_{max(i - 1, 0)}")
+        body.append(f"  JNZ label_{i}")
+        body.append("  SHL8")
+        body.append("  POP 2")
+        body.append(f"  JMP label_{i}")
+    return "\n".join(body) + "\n"
+
+
+def bench_assembler(lines, repeat):
+    source = generate_source(lines)
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        binary = Assembler.assemble(source)
+        times.append(perf_counter() - start)
+    best = min(times)
+    return {
+        "lines": source.count("\n"),
+        "source_bytes": len(source),
+        "binary_bytes": len(binary),
+        "seconds": best,
+        "lines_per_second": source.count("\n") / best,
+    }
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean": mean(samples),
+        "median": median(samples),
+        "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        "max": samples[-1],
+    }
+
+
+# POST /execute/<name> through the Flask app with the worker running; the
+# response is measured separately from the time until the worker reports
+# the new program
+def bench_switch(count):
+    os.environ["LUMINA_BACKEND"] = "virtual"
+    os.environ.setdefault("LUMINA_STORE", tempfile.mkdtemp(prefix="lumina-bench-"))
+    import server
+
+    server.current.start()
+    try:
+        client = server.app.test_client()
+        requests, switches = [], []
+        for i in range(count):
+            name = ("rainbow", "life")[i % 2]
+            start = perf_counter()
+            response = client.post(f"/execute/{name}")
+            requests.append(perf_counter() - start)
+            if response.status_code != 204:
+                raise RuntimeError(f"POST /execute/{name}: {response.status_code}")
+            while server.current.state()["program"] != name:
+                sleep(0.0001)
+            switches.append(perf_counter() - start)
+        return {"request_seconds": summary(requests), "switch_seconds": summary(switches)}
+    finally:
+        server.current.terminate()
+        server.current.join()
+
+
+# frames per second shown into the virtual backend, redrawing every frame
+def bench_frames(seconds):
+    results = {}
+    draws = {
+        "set_all_pixels": lambda pixels, i: pixels.set_all_pixels(i & 0xff, 0, 0),
+        "set_pixel": lambda pixels, i: [
+            pixels.set_pixel(i & 0xff, j, 0, j) for j in range(STRIP_LENGTH)
+        ],
+        "hue_gradient": lambda pixels, i: pixels.hue_gradient(i * 10, 50),
+    }
+    for name, draw in draws.items():
+        backend = VirtualBackend()
+        pixels = Pixels(STRIP_LENGTH, backend)
+        i = 0
+        start = perf_counter()
+        while perf_counter() - start < seconds:
+            i += 1
+            draw(pixels, i)
+            pixels.show()
+        elapsed = perf_counter() - start
+        results[name] = {"frames": backend.count, "seconds": elapsed,
+                         "per_second": backend.count / elapsed}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", type=str, metavar="file", dest="outfile")
+    parser.add_argument("--seconds", type=float, default=1.0,
+                        help="duration of each timed loop")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES),
+                        choices=list(ENGINES))
+    parser.add_argument("--assembler-lines", type=int, default=4096)
+    parser.add_argument("--switches", type=int, default=200)
+    args = parser.parse_args()
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "engines": bench_engines(args.engines, args.seconds),
+        "assembler": bench_assembler(args.assembler_lines, repeat=3),
+        "frames": bench_frames(args.seconds),
+        "switch": bench_switch(args.switches),
+    }
+    output = json.dumps(results, indent=2)
+    if args.outfile:
+        with open(args.outfile, "w") as outfile:
+            outfile.write(output + "\n")
+    else:
+        print(output)
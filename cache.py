@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+DEFAULT_CACHE_BYTES = 8 * 1024 * 1024
+
+
+class ProgramCache:
+    """LRU cache of prepared programs, keyed by bytecode hash and a tag for the form."""
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def key(data, tag):
+        return (sha256(data).digest(), tag)
+
+    # return the cached value for data, calling build(data) -> (value, size)
+    # to prepare and insert it on a miss
+    def get(self, data, tag, build):
+        key = ProgramCache.key(data, tag)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+        value, size = build(data)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.size += size
+            self.evict()
+        return value
+
+    def evict(self):
+        # always keep the newest entry, even if it alone exceeds the cap
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            key, (value, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
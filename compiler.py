@@ -0,0 +1,342 @@
+from math import floor, ceil, sin, cos
+import sys
+from time import perf_counter
+
+from program import ProgramError, MAX_STACK_DEPTH, DEADLINE_CHECK_INTERVAL
+from threaded import ThreadedProgram
+from verifier import VerifyError, analyse, stack_effect
+
+
+class CompileError(Exception):
+    pass
+
+
+# Compiler tier: PWLP bytecode is split into basic blocks and translated into
+# the source of a single Python function. The verifier's analysis gives the
+# stack depth at each reachable pc; when it is consistent, stack slot k lives
+# in the local variable s{k} and the generated code never touches
+# Program.stack except when calling back into a Program method. Anything the
+# analysis cannot prove (invalid or truncated instructions, possible
+# underflow, inconsistent depths at a join) raises CompileError, and
+# CompiledProgram falls back to threaded code.
+
+MAX_LOCALS = 64  # deepest stack kept in locals
+DISPATCH_LEAF = 8  # blocks tested in turn at the bottom of the dispatch tree
+
+UNARY = {
+    0x0: "{0} + 1",
+    0x1: "{0} - 1",
+    0x2: "~{0}",
+    0x3: "int(not {0})",
+    0x4: "{0} << 8",
+    0x5: "{0} >> 8",
+}
+
+BINARY = {
+    0x0: "{0} + {1}",
+    0x1: "{0} - {1}",
+    0x2: "{0} // {1}",
+    0x3: "{0} * {1}",
+    0x4: "{0} % {1}",
+    0x5: "{0} & {1}",
+    0x6: "{0} | {1}",
+    0x7: "{0} ^ {1}",
+    0x8: "{0} > {1}",
+    0x9: "{0} >= {1}",
+    0xa: "{0} < {1}",
+    0xb: "{0} <= {1}",
+    0xc: "{0} == {1}",
+    0xd: "{0} != {1}",
+    0xe: "{0} << {1}",
+    0xf: "{0} >> {1}",
+}
+
+FLOAT = {
+    0x0: "floor({0})",
+    0x1: "ceil({0})",
+    0x2: "sin({0})",
+    0x3: "cos({0})",
+}
+
+FDIV = "float({0}) / float({1})"
+
+# USER/SPECIAL functs that are called back on the Program
+CALLS = {
+    0xe1: "get_wall_time",
+    0xe2: "get_precise_time",
+    0xe4: "show",
+    0xe5: "random_int",
+    0xe8: "fill_pixels",
+    0xe9: "shift_pixels",
+    0xea: "rotate_pixels",
+    0xeb: "blend_pixels",
+    0xec: "hue_gradient",
+    0xf9: "sleep",
+    0xfc: "swap",
+    0xfd: "dump",
+    0xfe: "yield_",
+    0xff: "twobyte",
+}
+
+# calls that end a run_slice; the compiled function returns right after them
+SUSPENDS = {0xe4, 0xf9, 0xfe}
+
+def find_leaders(instructions):
+    leaders = {0}
+    for pc, (instruction, arg, next_pc) in instructions.items():
+        opcode = (instruction & 0xf0) >> 4
+        if opcode in (0x4, 0x5, 0x6, 0xc):
+            leaders.add(arg)
+            leaders.add(next_pc)
+        elif opcode == 0xb:
+            leaders.add(arg[1])
+        elif instruction in SUSPENDS:
+            leaders.add(next_pc)
+    return leaders
+
+
+class Generator:
+    """Emits the Python source for one analysed program."""
+
+    def __init__(self, data, max_depth=MAX_STACK_DEPTH):
+        self.end = len(data)
+        try:
+            self.instructions, self.depths = analyse(data, min(max_depth, MAX_LOCALS))
+        except VerifyError as error:
+            raise CompileError(str(error)) from error
+        self.leaders = {
+            pc for pc in find_leaders(self.instructions) if pc in self.instructions
+        }
+        self.lines = []
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    @staticmethod
+    def slots(depth):
+        return [f"s{k}" for k in range(depth)]
+
+    def load(self, indent, depth):
+        if depth:
+            self.emit(indent, f"{', '.join(self.slots(depth))}, = stack[:{depth}]")
+
+    def flush(self, indent, depth):
+        if depth:
+            self.emit(indent, f"stack[:{depth}] = {', '.join(self.slots(depth))},")
+        self.emit(indent, f"vm.sp = {depth}")
+
+    def goto(self, indent, target, depth):
+        if target >= self.end:
+            self.flush(indent, depth)
+            self.emit(indent, f"vm.pc = {self.end}")
+            self.emit(indent, "vm.halt()")
+            self.emit(indent, "return count")
+        else:
+            self.emit(indent, f"pc = {target}")
+
+    def block(self, indent, pc):
+        depth = self.depths[pc]
+        self.emit(indent, "if count >= budget:")
+        self.flush(indent + 1, depth)
+        self.emit(indent + 1, f"vm.pc = {pc}")
+        self.emit(indent + 1, "return count")
+        counter = len(self.lines)
+        self.emit(indent, "count += 1")
+        size = 0
+        while True:
+            size += 1
+            self.lines[counter] = "    " * indent + f"count += {size}"
+            instruction, arg, next_pc = self.instructions[pc]
+            opcode = (instruction & 0xf0) >> 4
+            funct = instruction & 0x0f
+            top = f"s{depth - 1}"
+            if opcode == 0x0:
+                depth -= arg
+            elif opcode in (0x1, 0x3):
+                self.emit(indent, f"s{depth} = {arg}")
+                depth += 1
+            elif opcode == 0x2:
+                self.emit(indent, f"s{depth} = s{depth - 1 - arg}")
+                depth += 1
+            elif opcode == 0x4:
+                self.goto(indent, arg, depth)
+                return
+            elif opcode in (0x5, 0x6):
+                test = "==" if opcode == 0x5 else "!="
+                self.emit(indent, f"if {top} {test} 0:")
+                self.goto(indent + 1, arg, depth)
+                self.emit(indent, "else:")
+                self.goto(indent + 1, next_pc, depth)
+                return
+            elif opcode == 0xa:
+                self.emit(indent, f"r, g, b = pixels.get_pixel(s{depth - 1 - arg})")
+                self.emit(indent, f"s{depth} = (b << 16) + (g << 8) + r")
+                depth += 1
+            elif opcode == 0xb:
+                delay, target = arg
+                self.emit(indent, f"s{depth} = {delay}")
+                self.flush(indent, depth + 1)
+                self.emit(indent, "vm.sleep()")
+                self.emit(indent, f"vm.pc = {min(target, self.end)}")
+                self.emit(indent, "return count")
+                return
+            elif opcode == 0xc:
+                self.emit(indent, f"s{depth} = {top} - pixels.length()")
+                depth += 1
+                self.emit(indent, f"if s{depth - 1} != 0:")
+                self.goto(indent + 1, arg, depth)
+                self.emit(indent, "else:")
+                self.goto(indent + 1, next_pc, depth)
+                return
+            elif opcode == 0xd:
+                add, multiply = arg
+                self.emit(indent, f"{top} = floor(({top} + {add}) * {multiply})")
+            elif opcode == 0x7:
+                self.emit(indent, f"{top} = {UNARY[funct].format(top)}")
+            elif opcode == 0x8 or instruction == 0x9f:
+                expression = BINARY[funct] if opcode == 0x8 else FDIV
+                left = f"s{depth - 2}"
+                self.emit(indent, f"{left} = {expression.format(left, top)}")
+                depth -= 1
+            elif opcode == 0x9:
+                self.emit(indent, f"{top} = {FLOAT[funct].format(top)}")
+            elif instruction == 0xe0:
+                self.emit(indent, f"s{depth} = pixels.length()")
+                depth += 1
+            elif instruction == 0xe3:
+                self.emit(
+                    indent,
+                    f"pixels.set_pixel({top} & 0xff, ({top} & 0xff00) >> 8, "
+                    f"({top} & 0xff0000) >> 16, s{depth - 2})",
+                )
+                depth -= 1
+            elif instruction == 0xe6:
+                self.emit(indent, f"r, g, b = pixels.get_pixel({top})")
+                self.emit(indent, f"{top} = (b << 16) + (g << 8) + r")
+            elif instruction == 0xe7:
+                self.emit(
+                    indent,
+                    f"pixels.set_all_pixels({top} & 0xff, ({top} & 0xff00) >> 8, "
+                    f"({top} & 0xff0000) >> 16)",
+                )
+                depth -= 1
+            elif instruction in CALLS:
+                self.flush(indent, depth)
+                self.emit(indent, f"vm.{CALLS[instruction]}()")
+                depth += stack_effect(instruction, arg)[1]
+                if instruction in SUSPENDS:
+                    self.emit(indent, f"vm.pc = {next_pc}")
+                    self.emit(indent, "return count")
+                    return
+                self.load(indent, depth)
+            elif instruction == 0xfa:
+                self.flush(indent, depth)
+                self.emit(indent, f"vm.pc = {next_pc}")
+                self.emit(indent, "vm.exit()")
+                self.emit(indent, "return count")
+                return
+            elif instruction == 0xfb:
+                self.flush(indent, depth)
+                self.emit(indent, f"vm.pc = {pc}")
+                self.emit(
+                    indent,
+                    f'raise ProgramError("An error was raised at instruction {pc}")',
+                )
+                return
+            pc = next_pc
+            if pc >= self.end or pc in self.leaders:
+                self.goto(indent, pc, depth)
+                return
+
+    # blocks starting at leaders, found by bisecting on pc so that a jump
+    # costs O(log blocks) comparisons and the if statements stay shallow
+    def dispatch(self, indent, leaders):
+        if len(leaders) <= DISPATCH_LEAF:
+            for i, pc in enumerate(leaders):
+                self.emit(indent, f"{'if' if i == 0 else 'elif'} pc == {pc}:")
+                self.block(indent + 1, pc)
+            return
+        middle = len(leaders) // 2
+        self.emit(indent, f"if pc < {leaders[middle]}:")
+        self.dispatch(indent + 1, leaders[:middle])
+        self.emit(indent, "else:")
+        self.dispatch(indent + 1, leaders[middle:])
+
+    def generate(self):
+        self.emit(0, "def run(vm, budget):")
+        self.emit(1, "count = 0")
+        self.emit(1, "stack = vm.stack")
+        self.emit(1, "pixels = vm.pixels")
+        self.emit(1, "pc = vm.pc")
+        # entries are only taken at their expected depth, so loading the
+        # slots depends on the depth alone
+        depths = sorted({self.depths[pc] for pc in self.leaders} - {0})
+        for i, depth in enumerate(depths):
+            self.emit(1, f"{'if' if i == 0 else 'elif'} vm.sp == {depth}:")
+            self.load(2, depth)
+        self.emit(1, "while True:")
+        self.dispatch(2, sorted(self.leaders))
+        return "\n".join(self.lines) + "\n"
+
+
+def compile_source(data, max_depth=MAX_STACK_DEPTH):
+    """Compile bytecode to Python source; raises CompileError if it cannot."""
+    generator = Generator(data, max_depth)
+    return generator.generate(), {pc: generator.depths[pc] for pc in generator.leaders}
+
+
+def compile_function(data, max_depth=MAX_STACK_DEPTH):
+    """Return (run, entries) where entries maps resumable pcs to stack depths."""
+    source, entries = compile_source(data, max_depth)
+    namespace = {
+        "floor": floor,
+        "ceil": ceil,
+        "sin": sin,
+        "cos": cos,
+        "ProgramError": ProgramError,
+    }
+    exec(compile(source, "<pwlp>", "exec"), namespace)
+    return namespace["run"], entries
+
+
+class CompiledProgram(ThreadedProgram):
+    """Program that runs bytecode compiled to a Python function when possible.
+
+    step() executes a single instruction as threaded code; run_slice() (and
+    so execute()) enters the compiled function whenever the program sits on a
+    block boundary with the expected stack depth, and step threaded code
+    otherwise. The compiled function only checks its instruction budget at
+    block boundaries, so a slice may overrun max_instructions by up to one
+    block. Programs the compiler cannot prove safe run entirely as threaded
+    code.
+    """
+
+    def load(self, name: str, data: bytes):
+        super().load(name, data)
+        self.compiled, self.entries = self.prepare(
+            data, ("compiled", self.max_depth), self.compile
+        )
+
+    def compile(self, data):
+        try:
+            run, entries = compile_function(data, self.max_depth)
+        except (CompileError, RecursionError, MemoryError, SyntaxError):
+            # the last three come from Python's compiler on huge programs
+            return (None, {}), 0
+        size = sys.getsizeof(run.__code__.co_code) + sys.getsizeof(entries)
+        return (run, entries), size
+
+    def burst(self, max_instructions, deadline):
+        if self.compiled is None:
+            return super().burst(max_instructions, deadline)
+        executed = 0
+        while executed < max_instructions and not self.suspended:
+            if self.entries.get(self.pc) == self.sp:
+                budget = min(max_instructions - executed, DEADLINE_CHECK_INTERVAL)
+                executed += self.compiled(self, budget)
+            else:
+                self.step()
+                executed += 1
+            if deadline is not None and perf_counter() >= deadline:
+                break
+        return executed
@@ -0,0 +1,15 @@
+from program import Program, TracedProgram
+from threaded import ThreadedProgram
+from compiler import CompiledProgram
+from profiler import ProfiledProgram
+
+# execution engines, selectable by name
+ENGINES = {
+    "interpreter": Program,
+    "threaded": ThreadedProgram,
+    "compiled": CompiledProgram,
+    "traced": TracedProgram,
+    "profiled": ProfiledProgram,
+}
+
+DEFAULT_ENGINE = "threaded"
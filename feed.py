@@ -0,0 +1,63 @@
+from base64 import b64encode
+from ctypes import c_uint8, c_ulong, memmove
+from multiprocessing.sharedctypes import RawArray, RawValue
+from time import perf_counter, sleep
+
+import numpy
+
+from pixels import Framebuffer
+
+FEED_FPS = 20.0  # default rate of the preview stream
+KEEPALIVE_SECONDS = 15.0  # longest the stream stays silent
+
+
+class SharedFrame:
+    """Latest frame shown on the strip, in shared memory.
+
+    The worker writes every frame it sends to the strip; readers in the
+    server copy it out without any message passing. The sequence number is
+    odd while a write is in progress, so a reader that sees it change (or
+    odd) retries instead of returning a torn frame.
+    """
+
+    def __init__(self, length):
+        self.n = length
+        self.buffer = RawArray(c_uint8, 3 * length)  # wire order
+        self.sequence = RawValue(c_ulong)
+
+    # runs in the worker: publish a wire-order frame
+    def write(self, frame):
+        self.sequence.value += 1
+        memmove(self.buffer, bytes(frame), 3 * self.n)
+        self.sequence.value += 1
+
+    # (sequence, frame) with the frame as r, g, b bytes per pixel
+    def read(self):
+        while True:
+            sequence = self.sequence.value
+            frame = bytes(self.buffer)
+            if sequence % 2 == 0 and sequence == self.sequence.value:
+                break
+            sleep(0)
+        pixels = numpy.frombuffer(frame, dtype=numpy.uint8).reshape(self.n, 3)
+        return sequence, pixels[:, list(Framebuffer.ORDER)].tobytes()
+
+
+def events(frame, fps=FEED_FPS):
+    """Server-sent events with each new frame as base64 r, g, b bytes.
+
+    At most fps frames are sent per second, and nothing but an occasional
+    keepalive comment while the strip does not change.
+    """
+    period = 1.0 / fps
+    last_sequence, last_sent = None, perf_counter()
+    while True:
+        sequence, pixels = frame.read()
+        now = perf_counter()
+        if sequence != last_sequence:
+            last_sequence, last_sent = sequence, now
+            yield f"data: {b64encode(pixels).decode('ascii')}\n\n"
+        elif now - last_sent >= KEEPALIVE_SECONDS:
+            last_sent = now
+            yield ": keepalive\n\n"
+        sleep(period)
@@ -0,0 +1,76 @@
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+from pixels import Framebuffer
+
+DEFAULT_FPS = 60.0
+
+
+class FrameGovernor(Framebuffer):
+    """Canvas whose shown frames a thread writes to the strip fps times a second.
+
+    show() only hands the frame over, and frames replaced before the next
+    write are dropped. Written frames also go to feed if given. With clock (a
+    time shared with other controllers) frames are written on its frame
+    boundaries.
+    """
+
+    def __init__(self, strip, fps: float = DEFAULT_FPS, feed=None, clock=None):
+        super().__init__(strip.length())
+        self.strip = strip
+        self.feed = feed
+        self.clock = clock
+        self.period = 1.0 / fps
+        self.lock = Lock()  # guards the strip's buffer
+        self.frames = 0  # frames written to the strip
+        self.show_seconds = 0.0  # time spent writing them
+        self.stopped = Event()
+        self.thread = Thread(target=self.render_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    # called by the scheduler: the canvas holds a finished frame
+    def show(self):
+        with self.lock:
+            if not self.dirty():
+                return False
+            self.strip.buffer[:] = self.buffer
+            self.strip.mark_dirty(self.dirty_start, self.dirty_end)
+            self.mark_clean()
+            return True
+
+    def render(self):
+        with self.lock:
+            start = perf_counter()
+            if self.strip.show():
+                self.frames += 1
+                if self.feed is not None:
+                    self.feed.write(self.strip.buffer)
+            self.show_seconds += perf_counter() - start
+
+    def render_loop(self):
+        deadline = perf_counter()
+        while not self.stopped.wait(max(0.0, deadline - perf_counter())):
+            self.render()
+            if self.clock is not None:
+                deadline = perf_counter() + self.until_boundary()
+                continue
+            deadline += self.period
+            # after a stall, carry on from now rather than catching up
+            deadline = max(deadline, perf_counter())
+
+    # seconds until the shared clock next crosses a frame boundary; waking
+    # slightly early must not render the same boundary twice
+    def until_boundary(self):
+        wait = -self.clock() % self.period
+        if wait < self.period / 2:
+            wait += self.period
+        return wait
+
+    def shutdown(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        with self.lock:
+            self.strip.shutdown()
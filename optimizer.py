@@ -0,0 +1,390 @@
+import argparse, json, sys
+from collections import Counter
+from time import perf_counter
+
+from verifier import VerifyError, analyse
+from threaded import UNARY_FUNCTS, BINARY_FUNCTS
+
+# Bytecode optimizer: a program is decoded into a list of instructions whose
+# jumps refer to other instructions rather than addresses, rewritten by a set
+# of peephole passes until none of them applies, and encoded again with the
+# jump addresses recomputed. Only programs the verifier's stack analysis can
+# prove (every reachable instruction valid, no underflow, consistent depths)
+# are optimized; this is what makes it safe to drop a PEEK or a branch that
+# would otherwise be the one to fail. Anything else is returned unchanged.
+
+PUSHZ, PUSHB, PUSHW = 0x10, 0x11, 0x31
+JMP, JZ, JNZ = 0x40, 0x50, 0x60
+SLEEP_JMP, SUB_LENGTH_JNZ, ADD_MUL_FLOOR = 0xb0, 0xc0, 0xd0
+INC, DEC = 0x70, 0x71
+ADD, SUB = 0x80, 0x81
+EXIT, ERROR = 0xfa, 0xfb
+
+MAX_WORD = 0xffffffff
+MAX_SECONDS = 1.0  # time an upload may spend being optimized
+
+
+class OptimizeError(Exception):
+    pass
+
+
+class Instruction:
+    """One decoded instruction; jumps keep their target in self.target."""
+
+    __slots__ = ("op", "arg", "target")
+
+    def __init__(self, op, arg=None, target=None):
+        self.op = op  # instruction byte, with the funct
+        self.arg = arg  # pushed value, POP/PEEK count or fused immediates
+        self.target = target
+
+    def is_push(self):
+        return self.op in (PUSHZ, PUSHB, PUSHW)
+
+    def is_jump(self):
+        return self.op in (JMP, JZ, JNZ)
+
+    # jumps and the fused instructions that end in one
+    def has_target(self):
+        return self.is_jump() or self.op in (SLEEP_JMP, SUB_LENGTH_JNZ)
+
+    # the jump a targeted instruction ends in
+    def test(self):
+        return {SLEEP_JMP: JMP, SUB_LENGTH_JNZ: JNZ}.get(self.op, self.op)
+
+    # whether execution can continue with the next instruction
+    def falls_through(self):
+        return self.op not in (JMP, SLEEP_JMP, EXIT, ERROR)
+
+    def size(self):
+        if self.op == PUSHB:
+            return 2
+        if self.op == PUSHW:
+            return 5
+        if self.op == SLEEP_JMP:
+            return 4
+        if self.has_target() or self.op == ADD_MUL_FLOOR:
+            return 3
+        return 1
+
+
+END = Instruction(None)  # jump target for the end of the program
+
+
+def push(value):
+    if value == 0:
+        return Instruction(PUSHZ, 0)
+    if value <= 0xff:
+        return Instruction(PUSHB, value)
+    return Instruction(PUSHW, value)
+
+
+def decode(data):
+    """Reachable instructions of data in address order."""
+    try:
+        instructions, depths = analyse(data)
+    except VerifyError as error:
+        raise OptimizeError(str(error)) from error
+    pcs = sorted(instructions)
+    for pc, following in zip(pcs, pcs[1:]):
+        if instructions[pc][2] > following:
+            raise OptimizeError(f"Overlapping instructions at {pc}")
+    code = {}
+    for pc in pcs:
+        op, arg, next_pc = instructions[pc]
+        opcode = op >> 4
+        if opcode in (0x0, 0x2, 0xa):
+            code[pc] = Instruction(op, op & 0x0f)
+        elif opcode in (0x1, 0x3):
+            # any nonzero funct reads an immediate, a zero one pushes 0
+            if not op & 0x0f:
+                code[pc] = Instruction(PUSHZ, 0)
+            else:
+                code[pc] = Instruction(PUSHB if opcode == 0x1 else PUSHW, arg)
+        elif opcode in (0x4, 0x5, 0x6, 0xc):
+            code[pc] = Instruction(op & 0xf0)  # the funct of a jump is unused
+        elif opcode == 0xb:
+            code[pc] = Instruction(SLEEP_JMP, arg[0])
+        elif opcode == 0xd:
+            code[pc] = Instruction(ADD_MUL_FLOOR, arg)
+        else:
+            code[pc] = Instruction(op)
+    for pc in pcs:
+        op, arg, next_pc = instructions[pc]
+        if code[pc].op == SLEEP_JMP:
+            arg = arg[1]
+        if code[pc].has_target():
+            code[pc].target = code.get(arg, END)  # past the end halts
+    return [code[pc] for pc in pcs]
+
+
+def encode(code):
+    addresses = {}
+    address = 0
+    for instruction in code:
+        addresses[id(instruction)] = address
+        address += instruction.size()
+    addresses[id(END)] = address
+    data = bytearray()
+    for instruction in code:
+        data.append(instruction.op)
+        if instruction.op in (PUSHB, SLEEP_JMP):
+            data.append(instruction.arg)
+        elif instruction.op == PUSHW:
+            data += instruction.arg.to_bytes(4, "little")
+        elif instruction.op == ADD_MUL_FLOOR:
+            data += bytes(instruction.arg)
+        if instruction.has_target():
+            data += addresses[id(instruction.target)].to_bytes(2, "little")
+    return bytes(data)
+
+
+class Optimizer:
+    """Rewrites one decoded program, counting the rewrites it makes.
+
+    Raises OptimizeError if it is still rewriting after deadline (a
+    perf_counter() value).
+    """
+
+    def __init__(self, code, deadline=None):
+        self.code = code
+        self.stats = Counter()
+        self.deadline = deadline
+        # id(instruction) -> {id(jump): jump} for the jumps that target it
+        self.referrers = {}
+        for instruction in code:
+            self.refer(instruction)
+
+    def refer(self, instruction):
+        if instruction.has_target():
+            self.referrers.setdefault(id(instruction.target), {})[id(instruction)] = instruction
+
+    def unrefer(self, instruction):
+        if instruction.has_target():
+            jumps = self.referrers.get(id(instruction.target))
+            if jumps is not None:
+                jumps.pop(id(instruction), None)
+                if not jumps:
+                    del self.referrers[id(instruction.target)]
+
+    def retarget(self, instruction, target):
+        self.unrefer(instruction)
+        instruction.target = target
+        self.refer(instruction)
+
+    def is_target(self, instruction):
+        return id(instruction) in self.referrers
+
+    def check_deadline(self):
+        if self.deadline is not None and perf_counter() > self.deadline:
+            raise OptimizeError("Optimizing took too long")
+
+    # replace code[start:stop] with new, moving jumps into the old window to
+    # its replacement (only code[start] may be a jump target)
+    def replace(self, start, stop, new):
+        old = self.code[start]
+        if new:
+            successor = new[0]
+        else:
+            successor = self.code[stop] if stop < len(self.code) else END
+        for instruction in self.code[start:stop]:
+            self.unrefer(instruction)
+        for instruction in list(self.referrers.get(id(old), {}).values()):
+            self.retarget(instruction, successor)
+        for instruction in new:
+            self.refer(instruction)
+        self.code[start:stop] = new
+
+    def peephole(self):
+        changed = False
+        i = 0
+        while i < len(self.code):
+            window = self.code[i : i + 3]
+            inner = [self.is_target(instruction) for instruction in window[1:]]
+            rewrite = self.rewrite(window, inner)
+            if rewrite is None:
+                i += 1
+                continue
+            self.check_deadline()
+            name, length, new = rewrite
+            self.stats[name] += 1
+            self.replace(i, i + length, new)
+            changed = True
+            i = max(0, i - 2)  # the replacement may complete an earlier pattern
+        return changed
+
+    # (name, instructions replaced, replacement) for the pattern at the start
+    # of window, or None; inner says which later instructions are jump targets
+    def rewrite(self, window, inner):
+        first = window[0]
+        second = window[1] if len(window) > 1 and not inner[0] else None
+        third = window[2] if second is not None and len(window) > 2 and not inner[1] else None
+
+        if first.op >> 4 == 0x0 and first.arg == 0:
+            return "remove POP 0", 1, []
+        if first.op == PUSHW and first.arg <= 0xff or first.op == PUSHB and first.arg == 0:
+            return "narrow push", 1, [push(first.arg)]
+        if second is None:
+            return None
+
+        if first.is_push():
+            value = first.arg
+            if third is not None and third.op >> 4 == 0x8 and second.is_push():
+                result = evaluate(BINARY_FUNCTS[third.op & 0x0f], value, second.arg)
+                if result is not None:
+                    return "fold binary", 3, [push(result)]
+            if second.op >> 4 == 0x7:
+                result = evaluate(UNARY_FUNCTS[second.op & 0x0f], value)
+                if result is not None:
+                    return "fold unary", 2, [push(result)]
+            if second.op in (JZ, JNZ):
+                if (value == 0) == (second.op == JZ):
+                    return "fold branch", 2, [first, Instruction(JMP, target=second.target)]
+                return "fold branch", 2, [first]
+            if value == 1 and second.op in (ADD, SUB):
+                return "increment", 2, [Instruction(INC if second.op == ADD else DEC)]
+
+        if (first.is_push() or first.op >> 4 == 0x2) and second.op >> 4 == 0x0 and second.arg:
+            # a value pushed only to be popped again
+            return "remove push and pop", 2, [Instruction(second.op - 1, second.arg - 1)]
+
+        return None
+
+    # point jumps at where their target jump would take them
+    def thread(self):
+        changed = False
+        index = {id(instruction): i for i, instruction in enumerate(self.code)}
+        for instruction in self.code:
+            if not instruction.has_target():
+                continue
+            test = instruction.test()
+            seen = set()
+            target = instruction.target
+            while target is not END and target.is_jump() and id(target) not in seen:
+                seen.add(id(target))
+                if target.op == JMP or target.op == test:
+                    # unconditional, or the same test on the same value
+                    following = target.target
+                elif test == JMP:
+                    break
+                else:
+                    # the opposite test on the same value falls through
+                    i = index[id(target)] + 1
+                    following = self.code[i] if i < len(self.code) else END
+                if following is target:
+                    break
+                target = following
+            if target is not instruction.target:
+                self.retarget(instruction, target)
+                self.stats["thread jump"] += 1
+                changed = True
+        return changed
+
+    # drop jumps to the next instruction; a conditional one does not pop and
+    # the analysis proved its operand is there
+    def remove_jumps(self):
+        changed = False
+        i = 0
+        while i < len(self.code):
+            instruction = self.code[i]
+            following = self.code[i + 1] if i + 1 < len(self.code) else END
+            if instruction.is_jump() and instruction.target is following:
+                self.stats["remove jump to next"] += 1
+                self.replace(i, i + 1, [])
+                changed = True
+            else:
+                i += 1
+        return changed
+
+    def remove_dead(self):
+        if not self.code:
+            return False
+        index = {id(instruction): i for i, instruction in enumerate(self.code)}
+        reachable = set()
+        pending = [0]
+        while pending:
+            i = pending.pop()
+            if i in reachable or i >= len(self.code):
+                continue
+            reachable.add(i)
+            instruction = self.code[i]
+            if instruction.has_target() and instruction.target is not END:
+                pending.append(index[id(instruction.target)])
+            if instruction.falls_through():
+                pending.append(i + 1)
+        if len(reachable) == len(self.code):
+            return False
+        self.stats["remove dead code"] += len(self.code) - len(reachable)
+        for i, instruction in enumerate(self.code):
+            if i not in reachable:
+                self.unrefer(instruction)
+        self.code = [instruction for i, instruction in enumerate(self.code) if i in reachable]
+        return True
+
+    def run(self):
+        changed = True
+        while changed:
+            changed = False
+            for rewrite in (self.peephole, self.thread, self.remove_jumps, self.remove_dead):
+                changed = rewrite() or changed
+                self.check_deadline()
+        return self.code
+
+
+# result of a folded operation if it can be pushed as an immediate
+def evaluate(funct, *operands):
+    if funct is BINARY_FUNCTS[0xe] and operands[1] > 32:
+        return None  # too wide to push, and possibly huge to compute
+    try:
+        result = funct(*operands)
+    except (ArithmeticError, ValueError):
+        return None  # leave the error to happen at run time
+    if type(result) is not int or not 0 <= result <= MAX_WORD:
+        return None  # bools, floats and negative numbers have no encoding
+    return result
+
+
+def optimize(data, seconds=MAX_SECONDS):
+    """Return (optimized data, report).
+
+    data is returned as is if it cannot be analysed, or if optimizing it
+    takes longer than seconds (None for no limit).
+    """
+    data = bytes(data)
+    report = {"bytes_before": len(data), "bytes_after": len(data)}
+    deadline = perf_counter() + seconds if seconds is not None else None
+    try:
+        code = decode(data)
+        before = len(code)
+        optimizer = Optimizer(code, deadline)
+        code = optimizer.run()
+    except OptimizeError as error:
+        report["skipped"] = str(error)
+        return data, report
+    if not code:
+        code = [Instruction(EXIT)]  # an empty program cannot run at all
+    optimized = encode(code)
+    report.update({
+        "bytes_after": len(optimized),
+        "instructions_before": before,
+        "instructions_after": len(code),
+        "rewrites": dict(optimizer.stats),
+    })
+    return optimized, report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", default=None, metavar="file", type=str)
+    parser.add_argument("-o", type=str, metavar="file", dest="outfile")
+    args = parser.parse_args()
+
+    with open(args.infile, "rb") as binary:
+        data = binary.read()
+    optimized, report = optimize(data)
+    print(json.dumps(report, indent=2), file=sys.stderr)
+    if args.outfile:
+        with open(args.outfile, "wb") as progfile:
+            progfile.write(optimized)
+    else:
+        sys.stdout.buffer.write(optimized)
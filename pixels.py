@@ -1,11 +1,17 @@
 #!/usr/bin/env python3.7
 
-import board
-import neopixel
+import numpy
 import time
 from math import sin, cos, tan, pi
 
-class Pixels:
+class Framebuffer:
+    """Strip-sized frame kept in wire order, with the range of changed pixels.
+
+    The frame is a contiguous bytearray already in the order the strip
+    expects, so set_pixel and get_pixel are plain byte accesses. Writes that
+    change a pixel widen the dirty range [dirty_start, dirty_end), which is
+    empty once the frame has been handed on.
+    """
 
     BLACK   = (  0,   0,   0)
     RED     = (255,   0,   0)
@@ -16,26 +22,286 @@ class Pixels:
     CYAN    = (  0, 255, 255)
     WHITE   = (255, 255, 255)
 
-    def __init__(self):
-        self.pixels = neopixel.NeoPixel(board.D18, 150, brightness=1)
+    # offsets of the red, green and blue bytes within each pixel on the wire
+    ORDER = (1, 2, 0)
+
+    # phases of the red, green and blue waves of hue_gradient in milliradians,
+    # the same offsets rainbow.asm uses
+    HUE_PHASES = (0, 2094, 4189)
+
+    def __init__(self, length=150):
+        self.n = length
+        self.buffer = bytearray(3 * length)
+        # (n, 3) view of the same memory for the whole-strip operations
+        self.array = numpy.frombuffer(self.buffer, dtype=numpy.uint8).reshape(length, 3)
+        # a new frame starts out dirty so that its first use covers the strip
+        self.dirty_start, self.dirty_end = 0, length
 
     def length(self):
-        return self.pixels.n
+        return self.n
+
+    def offset(self, i):
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError(f"Pixel index {i} out of range.")
+        return 3 * i
+
+    def mark_dirty(self, start, end):
+        self.dirty_start = min(self.dirty_start, start)
+        self.dirty_end = max(self.dirty_end, end)
+
+    def mark_clean(self):
+        self.dirty_start, self.dirty_end = self.n, 0
+
+    def dirty(self):
+        return self.dirty_start < self.dirty_end
 
     def set_pixel(self, r, g, b, i):
-        self.pixels[i] = ((r, b, g))
+        offset = self.offset(i)
+        red, green, blue = Framebuffer.ORDER
+        buffer = self.buffer
+        if buffer[offset + red] != r or buffer[offset + green] != g \
+                or buffer[offset + blue] != b:
+            buffer[offset + red] = r
+            buffer[offset + green] = g
+            buffer[offset + blue] = b
+            i = offset // 3
+            self.mark_dirty(i, i + 1)
+
+    # a colour as the three bytes it occupies on the wire
+    @staticmethod
+    def encode(r, g, b):
+        pixel = bytearray(3)
+        red, green, blue = Framebuffer.ORDER
+        pixel[red], pixel[green], pixel[blue] = r, g, b
+        return pixel
 
     def set_all_pixels(self, r, g, b):
-        self.pixels.fill((r, b, g))
+        frame = Framebuffer.encode(r, g, b) * self.n
+        if frame != self.buffer:
+            self.buffer[:] = frame
+            self.mark_dirty(0, self.n)
 
     def get_pixel(self, i):
-        return self.pixels[i]
+        offset = self.offset(i)
+        red, green, blue = Framebuffer.ORDER
+        return (
+            self.buffer[offset + red],
+            self.buffer[offset + green],
+            self.buffer[offset + blue],
+        )
+
+    # replace pixels [start, end) with values, marking them dirty if they differ
+    def update(self, start, end, values):
+        if not (self.array[start:end] == values).all():
+            self.array[start:end] = values
+            self.mark_dirty(start, end)
+
+    # set pixels [start, end), clipped to the strip, to one colour
+    def fill_pixels(self, r, g, b, start, end):
+        start, end = max(0, start), min(self.n, end)
+        if start < end:
+            self.update(start, end, numpy.frombuffer(Framebuffer.encode(r, g, b), numpy.uint8))
+
+    # move every pixel count places up the strip (down if negative),
+    # filling the pixels left behind with black
+    def shift_pixels(self, count):
+        count = max(-self.n, min(self.n, count))
+        shifted = numpy.zeros_like(self.array)
+        if count >= 0:
+            shifted[count:] = self.array[: self.n - count]
+        else:
+            shifted[: self.n + count] = self.array[-count:]
+        self.update(0, self.n, shifted)
+
+    # move every pixel count places up the strip, wrapping around the end
+    def rotate_pixels(self, count):
+        self.update(0, self.n, numpy.roll(self.array, count, axis=0))
+
+    # move every pixel amount/255 of the way towards one colour
+    def blend_pixels(self, r, g, b, amount):
+        amount = max(0, min(255, amount))
+        target = numpy.frombuffer(Framebuffer.encode(r, g, b), numpy.uint8)
+        blended = (
+            self.array.astype(numpy.int32) * (255 - amount)
+            + target.astype(numpy.int32) * amount
+            + 127
+        ) // 255
+        self.update(0, self.n, blended.astype(numpy.uint8))
+
+    # rainbow.asm's colour wave at angle (phase + i * step) / 1000 for pixel i
+    def hue_gradient(self, phase, step):
+        angles = phase + numpy.arange(self.n) * step
+        gradient = numpy.empty_like(self.array)
+        for channel, offset in zip(Framebuffer.ORDER, Framebuffer.HUE_PHASES):
+            gradient[:, channel] = numpy.floor(
+                (numpy.sin((angles + offset) / 1000.0) + 1) * 127
+            )
+        self.update(0, self.n, gradient)
+
+
+class Segment(Framebuffer):
+    """Zone of a strip, pixels [start, start + length), drawn by its own program.
+
+    show() marks a finished frame, which compose() copies into the strip's
+    framebuffer at the zone's offset.
+    """
+
+    def __init__(self, start, length):
+        super().__init__(length)
+        self.start = start
+        self.shown = False  # whether the program has called show yet
+        self.ready = False  # whether a finished frame awaits compose
+
+    # the zone has a new program, which has not called show yet
+    def reset(self):
+        self.shown = False
+        self.ready = False
+
+    def show(self):
+        self.shown = True
+        self.ready = self.dirty()  # an empty show leaves nothing to compose
+        return self.ready
+
+    # copy the changed pixels into target at the segment's offset, returning
+    # whether anything was copied; a frame still being drawn is left alone
+    def compose(self, target):
+        if not self.dirty() or (self.shown and not self.ready):
+            return False
+        start, end = self.dirty_start, self.dirty_end
+        offset = 3 * self.start
+        target.buffer[offset + 3 * start : offset + 3 * end] = self.buffer[3 * start : 3 * end]
+        target.mark_dirty(self.start + start, self.start + end)
+        self.mark_clean()
+        self.ready = False
+        return True
+
+    # the strip belongs to whoever composes the segment; just go dark
+    def shutdown(self):
+        self.set_all_pixels(*Segment.BLACK)
+        self.show()
+
+
+class Backend:
+    """Destination for the frames a Pixels strip shows.
+
+    open(length) is called once with the strip length. write(frame, start,
+    end) receives the whole wire-order frame along with the range of pixels
+    that changed since the previous write, and close() releases the device.
+    """
+
+    def open(self, length):
+        pass
+
+    def write(self, frame, start, end):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NeoPixelBackend(Backend):
+    """WS281x strip driven through neopixel_write on a Raspberry Pi pin.
+
+    The board libraries are only imported when the backend is opened, so
+    this module can be used on machines without them.
+    """
+
+    def __init__(self, pin=None):
+        self.pin_id = pin  # board.D18 unless given
+
+    def open(self, length):
+        import board
+        import digitalio
+        from neopixel_write import neopixel_write
+
+        self.neopixel_write = neopixel_write
+        self.pin = digitalio.DigitalInOut(self.pin_id if self.pin_id is not None else board.D18)
+        self.pin.direction = digitalio.Direction.OUTPUT
+
+    # always the whole frame, and always the same buffer object: the Pi
+    # driver sizes the strip from it and re-initialises itself whenever it
+    # is handed a different one
+    def write(self, frame, start, end):
+        self.neopixel_write(self.pin, frame)
+
+    def close(self):
+        self.pin.deinit()
+
+
+class VirtualBackend(Backend):
+    """Hardware-free strip that records the frames it is shown.
+
+    Frames and their perf_counter() timestamps go into ring buffers that are
+    allocated when the strip is opened, so recording never allocates; only
+    the newest capacity frames are kept.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self.count = 0  # frames written so far, including overwritten ones
+
+    def open(self, length):
+        self.n = length
+        self.frames = numpy.zeros((self.capacity, 3 * length), dtype=numpy.uint8)
+        self.timestamps = numpy.zeros(self.capacity)
+
+    def write(self, frame, start, end):
+        slot = self.count % self.capacity
+        self.frames[slot] = numpy.frombuffer(frame, dtype=numpy.uint8)
+        self.timestamps[slot] = time.perf_counter()
+        self.count += 1
+
+    # (timestamps, frames) for the recorded frames, oldest first; frames has
+    # shape (k, length, 3) with the colours in (r, g, b) order
+    def recorded(self):
+        kept = min(self.count, self.capacity)
+        order = numpy.arange(self.count - kept, self.count) % self.capacity
+        frames = self.frames[order].reshape(kept, self.n, 3)
+        return self.timestamps[order], frames[:, :, list(Framebuffer.ORDER)]
+
+    # (timestamp, frame) for the newest frame, or None before the first show
+    def latest(self):
+        if self.count == 0:
+            return None
+        slot = (self.count - 1) % self.capacity
+        frame = self.frames[slot].reshape(self.n, 3)
+        return self.timestamps[slot], frame[:, list(Framebuffer.ORDER)]
+
+
+BACKENDS = {
+    "neopixel": NeoPixelBackend,
+    "virtual": VirtualBackend,
+}
+
+DEFAULT_BACKEND = "neopixel"
+
+
+class Pixels(Framebuffer):
+    """Framebuffer for a strip, handed to its backend in one write on show().
+
+    show() skips the backend entirely when the dirty range is empty. The
+    default backend drives the WS281x strip on the Raspberry Pi.
+    """
+
+    def __init__(self, length=150, backend: Backend = None):
+        super().__init__(length)
+        self.backend = backend if backend is not None else NeoPixelBackend()
+        self.backend.open(length)
 
+    # push the frame if it changed, returning whether anything was sent
     def show(self):
-        self.pixels.show()
+        if not self.dirty():
+            return False
+        self.backend.write(self.buffer, self.dirty_start, self.dirty_end)
+        self.mark_clean()
+        return True
 
     def shutdown(self):
-        self.pixels.deinit()
+        self.set_all_pixels(*Pixels.BLACK)
+        self.show()
+        self.backend.close()
 
 if __name__ == "__main__":
     try:
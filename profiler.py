@@ -0,0 +1,87 @@
+from time import perf_counter
+
+from assembler import Assembler
+from program import Program
+from threaded import ThreadedProgram
+from verifier import mnemonic
+
+
+class ProfiledProgram(ThreadedProgram):
+    """Threaded program that counts executions and time spent at every pc.
+
+    Instructions are stepped one at a time and each is timed on its own, so
+    the program runs a good deal slower than under the plain threaded engine.
+    The counts in self.counts start over whenever a program is loaded;
+    report() turns them into per-opcode and per-pc totals.
+    """
+
+    def reset(self):
+        super().reset()
+        self.counts = {}  # pc -> [executions, seconds]
+
+    def step(self):
+        pc = self.pc
+        start = perf_counter()
+        super().step()
+        elapsed = perf_counter() - start
+        counts = self.counts.get(pc)
+        if counts is None:
+            self.counts[pc] = [1, elapsed]
+        else:
+            counts[0] += 1
+            counts[1] += elapsed
+
+    # step() rather than the threaded inner loop, so every pc is timed
+    burst = Program.burst
+
+
+def report(data, counts, source=None, top=20):
+    """Summarise the counts of a ProfiledProgram running data.
+
+    Opcodes and the top hottest pcs are sorted by time spent. If the
+    assembler source of the program is given (and assembles to data), each
+    pc is mapped back to its source line and the label it follows.
+    """
+    source_map = None
+    if source is not None:
+        binary, source_map = Assembler.assemble_mapped(source)
+        if bytes(binary) != bytes(data):
+            source_map = None  # stale source, the lines would be wrong
+    labels = sorted(
+        (pc, label)
+        for label, pc in (source_map or {}).get("labels", {}).items()
+        if pc is not None
+    )
+    lines = source.split("\n") if source_map is not None else []
+
+    opcodes = {}
+    for pc, (count, seconds) in counts.items():
+        name = mnemonic(data[pc])
+        totals = opcodes.setdefault(name, {"instruction": name, "count": 0, "seconds": 0.0})
+        totals["count"] += count
+        totals["seconds"] += seconds
+
+    pcs = []
+    hottest = sorted(counts.items(), key=lambda item: item[1][1], reverse=True)
+    for pc, (count, seconds) in hottest[:top]:
+        entry = {
+            "pc": pc,
+            "instruction": mnemonic(data[pc]),
+            "count": count,
+            "seconds": seconds,
+        }
+        if source_map is not None:
+            line = source_map["lines"].get(pc)
+            entry["line"] = line
+            entry["source"] = lines[line - 1].strip() if line is not None else None
+            entry["label"] = next(
+                (label for start, label in reversed(labels) if start <= pc), None
+            )
+        pcs.append(entry)
+
+    return {
+        "instructions": sum(count for count, seconds in counts.values()),
+        "seconds": sum(seconds for count, seconds in counts.values()),
+        "opcodes": sorted(opcodes.values(), key=lambda totals: totals["seconds"], reverse=True),
+        "pcs": pcs,
+    }
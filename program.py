@@ -1,35 +1,25 @@
-from collections import deque
-from time import time, sleep
+from collections import deque, namedtuple
+from time import time, sleep, perf_counter
 import math
 
+from pixels import Pixels, VirtualBackend
+
 class ProgramError(Exception):
     pass
 
-class Program:
-
-    class Pixels:
-        """Placeholder class to mimic the arduino/led functionality."""
-
-        def __init__(self, length=50):
-            self.pixels = [(0, 0, 0) for i in range(length)]
-
-        def length(self):
-            return len(self.pixels)
-
-        def set_pixel(self, r, g, b, i):
-            self.pixels[i] = ((r, b, g))
+MAX_STACK_DEPTH = 256
+SLICE_INSTRUCTIONS = 1000  # default instruction budget for run_slice
+DEADLINE_CHECK_INTERVAL = 256  # instructions between deadline checks
 
-        def set_all_pixels(self, r, g, b):
-            self.pixels = [(r, b, g) for i in range(length)]
-
-        def get_pixel(self, i):
-            return self.pixels[i]
+class Program:
 
-    def __init__(self, name: str, data: bytes, debug: bool = False, pixels = None):
-        self.name = name
-        self.data = data
-        self.debug = debug
-        self.pixels = pixels if pixels is not None else Program.Pixels()
+    def __init__(self, name: str, data: bytes, pixels = None,
+                 max_depth: int = MAX_STACK_DEPTH, cache = None, clock = None):
+        self.max_depth = max_depth
+        self.cache = cache
+        # wall clock in seconds for get_wall_time and get_precise_time
+        self.clock = clock if clock is not None else time
+        self.pixels = pixels if pixels is not None else Pixels(50, VirtualBackend())
 
         self.OPCODES = {
             0x0: self.POP,
@@ -42,6 +32,10 @@ class Program:
             0x7: self.UNARY,
             0x8: self.BINARY,
             0x9: self.FLOAT,
+            0xa: self.PEEK_PIXEL,
+            0xb: self.SLEEP_JMP,
+            0xc: self.SUB_LENGTH_JNZ,
+            0xd: self.ADD_MUL_FLOOR,
             0xe: self.USER,
             0xf: self.SPECIAL,
         }
@@ -91,6 +85,11 @@ class Program:
             0x5: self.random_int,
             0x6: self.get_pixel,
             0x7: self.set_all_pixels,
+            0x8: self.fill_pixels,
+            0x9: self.shift_pixels,
+            0xa: self.rotate_pixels,
+            0xb: self.blend_pixels,
+            0xc: self.hue_gradient,
         }
 
         self.SPECIAL_FUNCTS = {
@@ -103,12 +102,48 @@ class Program:
             0xf: self.twobyte,
         }
         
+        self.load(name, data)
+
+    # swap in new bytecode, keeping the pixels and handler tables
+    def load(self, name: str, data: bytes):
+        self.name = name
+        self.data = data
         self.reset()
 
+    # engine-specific form of data, shared through the cache if there is one
+    # build(data) returns the form and its approximate size in bytes
+    def prepare(self, data, tag, build):
+        if self.cache is None:
+            return build(data)[0]
+        return self.cache.get(data, tag, build)
+
     def reset(self):
-        self.stack = deque()
+        # preallocated stack, self.sp is the number of items on it
+        self.stack = [None] * self.max_depth
+        self.sp = 0
         self.pc = 0
         self.running = True
+        self.suspended = False
+        self.wake_time = 0.0  # perf_counter() value at which a sleep ends
+
+    # stop the program and end the current slice
+    def halt(self):
+        self.running = False
+        self.suspended = True
+
+    # push value onto stack
+    def push(self, value):
+        if self.sp >= self.max_depth:
+            raise ProgramError(f"Stack overflow, maximum depth is {self.max_depth}.")
+        self.stack[self.sp] = value
+        self.sp += 1
+
+    # pop value from top of stack
+    def pop(self):
+        if self.sp < 1:
+            raise ProgramError(f"Not enough items in stack.")
+        self.sp -= 1
+        return self.stack[self.sp]
     
     # execute current instruction
     def step(self):
@@ -116,20 +151,49 @@ class Program:
         opcode = (instruction & 0xf0) >> 4
         if opcode not in self.OPCODES:
             raise ProgramError(f"Invalid opcode: {opcode}")
-        if (self.debug):
-            print(f"\tpc: {self.pc} ({hex(self.pc)})")
-            print(f"\tinst: {hex(instruction)}")
-            data = self.data[self.pc : self.pc + 4]
-            print(f"\tdata: {' '.join([hex(datum) for datum in data])}")
-            print(f"\tstack: {self.stack}")
         self.OPCODES[opcode]()
         self.pc += 1
         if not self.pc < len(self.data):
-            self.running = False
+            self.halt()
 
     def execute(self):
         while self.running:
+            self.run_slice()
+            self.wait()
+
+    # block until the current sleep is over
+    def wait(self):
+        delay = self.wake_time - perf_counter()
+        if delay > 0:
+            sleep(delay)
+
+    # whether the program is waiting for its wake time
+    def sleeping(self):
+        return self.running and perf_counter() < self.wake_time
+
+    # execute a burst of instructions, returning how many were executed
+    # the slice ends early after yield, show, sleep or exit, or once the
+    # deadline (a perf_counter() value) has passed; a sleeping program
+    # executes nothing until its wake time
+    def run_slice(self, max_instructions: int = SLICE_INSTRUCTIONS, deadline: float = None):
+        if not self.running or self.sleeping():
+            return 0
+        self.suspended = False
+        executed = self.burst(max_instructions, deadline)
+        if not self.pc < len(self.data):
+            self.halt()
+        return executed
+
+    # engine-specific part of run_slice
+    def burst(self, max_instructions, deadline):
+        executed = 0
+        while executed < max_instructions and not self.suspended:
             self.step()
+            executed += 1
+            if deadline is not None and executed % DEADLINE_CHECK_INTERVAL == 0 \
+                    and perf_counter() >= deadline:
+                break
+        return executed
     
     # read byte from data
     def read_byte(self):
@@ -150,104 +214,81 @@ class Program:
             + (self.read_byte() << 24)
 
     def POP(self):
-        if (self.debug):
-            print('POP')
         instruction = self.data[self.pc]
         arg = instruction & 0x0f
-        if len(self.stack) < arg:
+        if self.sp < arg:
             raise ProgramError(f"Cannot pop beyond stack index.")
-        for i in range(arg):
-            del self.stack[0]
+        self.sp -= arg
     
     def PUSH(self):
-        if (self.debug):
-            print('PUSH')
         instruction = self.data[self.pc]
         arg = instruction & 0x0f
         if arg != 0:
             arg = self.read_byte()
-        self.stack.appendleft(arg)
+        self.push(arg)
 
     def PEEK(self):
-        if (self.debug):
-            print('PEEK')
         instruction = self.data[self.pc]
         arg = instruction & 0x0f
-        if not len(self.stack) > arg:
+        if not self.sp > arg:
             raise ProgramError(f"Cannot peek beyond stack index.")
-        val = self.stack[arg]
-        self.stack.appendleft(val)
+        val = self.stack[self.sp - 1 - arg]
+        self.push(val)
 
     def PUSHI(self):
-        if (self.debug):
-            print('PUSHI')
         instruction = self.data[self.pc]
         arg = instruction & 0x0f
         if arg != 0:
             arg = self.read_word()
-        self.stack.appendleft(arg)
+        self.push(arg)
 
     def JMP(self):
-        if (self.debug):
-            print('JMP')
         self.pc = self.read_short() - 1
 
     def JZ(self):
-        if (self.debug):
-            print('JZ')
-        if len(self.stack) < 1:
+        if self.sp < 1:
             raise ProgramError(f"Not enough items in stack.")
-        if self.stack[0] == 0:
+        if self.stack[self.sp - 1] == 0:
             self.pc = self.read_short() - 1
         else:
             self.pc += 2
 
     def JNZ(self):
-        if (self.debug):
-            print('JNZ')
-        if len(self.stack) < 1:
+        if self.sp < 1:
             raise ProgramError(f"Not enough items in stack.")
-        if self.stack[0] != 0:
+        if self.stack[self.sp - 1] != 0:
             self.pc = self.read_short() - 1
         else:
             self.pc += 2
 
     def UNARY(self):
-        if (self.debug):
-            print('UNARY')
         instruction = self.data[self.pc]
         funct = instruction & 0x0f
         if funct not in self.UNARY_FUNCTS:
             raise ProgramError(f"Invalid unary funct: {funct}")
-        if len(self.stack) < 1:
+        if self.sp < 1:
             raise ProgramError(f"Not enough items in stack.")
         self.UNARY_FUNCTS[funct]()
 
     def BINARY(self):
-        if (self.debug):
-            print('BINARY')
         instruction = self.data[self.pc]
         funct = instruction & 0x0f
         if funct not in self.BINARY_FUNCTS:
             raise ProgramError(f"Invalid binary funct: {funct}")
-        if len(self.stack) < 2:
+        if self.sp < 2:
             raise ProgramError(f"Not enough items in stack.")
         self.BINARY_FUNCTS[funct]()
 
     def FLOAT(self):
-        if (self.debug):
-            print('FLOAT')
         instruction = self.data[self.pc]
         funct = instruction & 0x0f
         if funct not in self.FLOAT_FUNCTS:
             raise ProgramError(f"Invalid binary funct: {funct}")
-        if len(self.stack) < 1:
+        if self.sp < 1:
             raise ProgramError(f"Not enough items in stack.")
         self.FLOAT_FUNCTS[funct]()
 
     def USER(self):
-        if (self.debug):
-            print('USER')
         instruction = self.data[self.pc]
         funct = instruction & 0x0f
         if funct not in self.USER_FUNCTS:
@@ -255,285 +296,301 @@ class Program:
         self.USER_FUNCTS[funct]()
 
     def SPECIAL(self):
-        if (self.debug):
-            print('SPECIAL')
         instruction = self.data[self.pc]
         funct = instruction & 0x0f
         if funct not in self.SPECIAL_FUNCTS:
             raise ProgramError(f"Invalid special funct: {funct}")
         self.SPECIAL_FUNCTS[funct]()
 
+    # fused instructions, each doing the work of a common sequence in one
+    # dispatch; they fail exactly where the sequence would
+
+    # PEEK n; get_pixel
+    def PEEK_PIXEL(self):
+        self.PEEK()
+        self.get_pixel()
+
+    # PUSHB k; sleep; JMP target
+    def SLEEP_JMP(self):
+        self.push(self.read_byte())
+        self.sleep()
+        self.JMP()
+
+    # PEEK 0; get_length; SUB; JNZ target
+    def SUB_LENGTH_JNZ(self):
+        if self.sp < 1:
+            raise ProgramError(f"Cannot peek beyond stack index.")
+        self.push(self.stack[self.sp - 1])
+        self.get_length()
+        self.SUB()
+        self.JNZ()
+
+    # PUSHB a; ADD; PUSHB b; MUL; FLOOR
+    def ADD_MUL_FLOOR(self):
+        self.push(self.read_byte())
+        if self.sp < 2:
+            raise ProgramError(f"Not enough items in stack.")
+        self.ADD()
+        self.push(self.read_byte())
+        self.MUL()
+        self.FLOOR()
+
     def INC(self):
-        if (self.debug):
-            print('\tINC')
-        self.stack.appendleft(self.stack.popleft() + 1)
+        self.push(self.pop() + 1)
 
     def DEC(self):
-        if (self.debug):
-            print('\tDEC')
-        self.stack.appendleft(self.stack.popleft() - 1)
+        self.push(self.pop() - 1)
 
     def NOT(self):
-        if (self.debug):
-            print('\tNOT')
-        self.stack.appendleft(~self.stack.popleft())
+        self.push(~self.pop())
 
     def NEG(self):
-        if (self.debug):
-            print('\tNEG')
-        self.stack.appendleft(int(not self.stack.popleft()))
+        self.push(int(not self.pop()))
 
     def SHL8(self):
-        if (self.debug):
-            print('\tSHL8')
-        self.stack.appendleft(self.stack.popleft() << 8)
+        self.push(self.pop() << 8)
 
     def SHR8(self):
-        if (self.debug):
-            print('\tSHR8')
-        self.stack.appendleft(self.stack.popleft() >> 8)
+        self.push(self.pop() >> 8)
 
     def ADD(self):
-        if (self.debug):
-            print('\tADD')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left + right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left + right)
 
     def SUB(self):
-        if (self.debug):
-            print('\tSUB')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left - right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left - right)
 
     def DIV(self):
-        if (self.debug):
-            print('\tDIV')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left // right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left // right)
 
     def MUL(self):
-        if (self.debug):
-            print('\tMUL')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left * right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left * right)
 
     def MOD(self):
-        if (self.debug):
-            print('\tMOD')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        if (self.debug):
-            print(f'\t{left}%{right}')
-        self.stack.appendleft(left % right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left % right)
 
     def AND(self):
-        if (self.debug):
-            print('\tAND')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left & right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left & right)
 
     def OR(self):
-        if (self.debug):
-            print('\tOR')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left | right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left | right)
 
     def XOR(self):
-        if (self.debug):
-            print('\tXOR')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left ^ right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left ^ right)
 
     def GT(self):
-        if (self.debug):
-            print('\tGT')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left > right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left > right)
 
     def GTE(self):
-        if (self.debug):
-            print('\tGTE')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left >= right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left >= right)
 
     def LT(self):
-        if (self.debug):
-            print('\tLT')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left < right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left < right)
 
     def LTE(self):
-        if (self.debug):
-            print('\tLTE')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left <= right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left <= right)
 
     def EQ(self):
-        if (self.debug):
-            print('\tEQ')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left == right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left == right)
 
     def NEQ(self):
-        if (self.debug):
-            print('\tNEQ')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left != right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left != right)
 
     def SHL(self):
-        if (self.debug):
-            print('\tSHL')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left << right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left << right)
 
     def SHR(self):
-        if (self.debug):
-            print('\tSHR')
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(left >> right)
+        right = self.pop()
+        left = self.pop()
+        self.push(left >> right)
 
     def FLOOR(self):
-        if (self.debug):
-            print('\tFLOOR')
-        self.stack.appendleft(math.floor(self.stack.popleft()))
+        self.push(math.floor(self.pop()))
 
     def CEIL(self):
-        if (self.debug):
-            print('\tCEIL')
-        self.stack.appendleft(math.ceil(self.stack.popleft()))
+        self.push(math.ceil(self.pop()))
 
     def SIN(self):
-        if (self.debug):
-            print('\tSIN')
-        self.stack.appendleft(math.sin(self.stack.popleft()))
+        self.push(math.sin(self.pop()))
 
     def COS(self):
-        if (self.debug):
-            print('\tCOS')
-        self.stack.appendleft(math.cos(self.stack.popleft()))
+        self.push(math.cos(self.pop()))
 
     def FDIV(self):
-        if (self.debug):
-            print('\tFDIV')
-        if len(self.stack) < 2:
+        if self.sp < 2:
             raise ProgramError(f"Not enough items in stack.")
-        right = self.stack.popleft()
-        left = self.stack.popleft()
-        self.stack.appendleft(float(left) / float(right))
+        right = self.pop()
+        left = self.pop()
+        self.push(float(left) / float(right))
 
     def get_length(self):
-        if (self.debug):
-            print('\tget_length')
-        self.stack.appendleft(self.pixels.length())
+        self.push(self.pixels.length())
 
     def get_wall_time(self):
-        if (self.debug):
-            print('\tget_wall_time')
-        self.stack.appendleft(int(time()))
+        self.push(int(self.clock()))
 
     def get_precise_time(self):
-        if (self.debug):
-            print('\tget_precise_time')
-        self.stack.appendleft(int(time() * 1000))
+        self.push(int(self.clock() * 1000))
 
     def set_pixel(self):
-        if (self.debug):
-            print('\tset_pixel')
-        if len(self.stack) < 2:
+        if self.sp < 2:
             raise ProgramError(f"Not enough items in stack.")
-        color = self.stack.popleft()
+        color = self.pop()
         b = (color & 0xff0000) >> 16
         g = (color & 0x00ff00) >> 8
         r = (color & 0x0000ff)
-        i = self.stack[0]
+        i = self.stack[self.sp - 1]
         self.pixels.set_pixel(r, g, b, i)
 
     def show(self):
-        if (self.debug):
-            print('\tshow')
         self.pixels.show()
+        self.suspended = True
 
     def random_int(self):
-        if (self.debug):
-            print('\trandom_int')
-        self.stack.appendleft(4)
+        self.push(4)
         # stub
 
     def get_pixel(self):
-        if (self.debug):
-            print('\tget_pixel')
-        if len(self.stack) < 1:
+        if self.sp < 1:
             raise ProgramError(f"Not enough items in stack.")
-        r, g, b = self.pixels.get_pixel(self.stack.popleft())
+        r, g, b = self.pixels.get_pixel(self.pop())
         color = (b << 16) + (g << 8) + (r)
-        self.stack.appendleft(color)
+        self.push(color)
 
     def set_all_pixels(self):
-        if (self.debug):
-            print('\tset_all_pixels')
-        if len(self.stack) < 1:
+        if self.sp < 1:
             raise ProgramError(f"Not enough items in stack.")
-        color = self.stack.popleft()
+        color = self.pop()
         b = (color & 0xff0000) >> 16
         g = (color & 0x00ff00) >> 8
         r = (color & 0x0000ff)
         self.pixels.set_all_pixels(r, g, b)
 
+    # pop a colour and split it into its red, green and blue bytes
+    def pop_color(self):
+        color = int(self.pop())
+        return color & 0x0000ff, (color & 0x00ff00) >> 8, (color & 0xff0000) >> 16
+
+    def fill_pixels(self):
+        if self.sp < 3:
+            raise ProgramError(f"Not enough items in stack.")
+        r, g, b = self.pop_color()
+        end = int(self.pop())
+        start = int(self.pop())
+        self.pixels.fill_pixels(r, g, b, start, end)
+
+    def shift_pixels(self):
+        if self.sp < 1:
+            raise ProgramError(f"Not enough items in stack.")
+        self.pixels.shift_pixels(int(self.pop()))
+
+    def rotate_pixels(self):
+        if self.sp < 1:
+            raise ProgramError(f"Not enough items in stack.")
+        self.pixels.rotate_pixels(int(self.pop()))
+
+    def blend_pixels(self):
+        if self.sp < 2:
+            raise ProgramError(f"Not enough items in stack.")
+        amount = int(self.pop())
+        r, g, b = self.pop_color()
+        self.pixels.blend_pixels(r, g, b, amount)
+
+    def hue_gradient(self):
+        if self.sp < 2:
+            raise ProgramError(f"Not enough items in stack.")
+        step = self.pop()
+        phase = self.pop()
+        self.pixels.hue_gradient(phase, step)
+
     def sleep(self):
-        if (self.debug):
-            print('\tsleep')
-        sleep(float(self.stack.popleft()) / 1000.0)
+        self.wake_time = perf_counter() + float(self.pop()) / 1000.0
+        self.suspended = True
 
     def exit(self):
-        if (self.debug):
-            print('\texit')
-        self.running = False
-        self.terminate()
+        self.halt()
 
     def error(self):
-        if (self.debug):
-            print('\terror')
         raise ProgramError(f"An error was raised at instruction {self.pc}")
 
     def swap(self):
-        if (self.debug):
-            print('\tswap')
-        # stub
+        pass  # stub
 
     def dump(self):
-        if (self.debug):
-            print('\tdump')
-        print(self.stack)
+        print(self.stack[:self.sp])
 
     def yield_(self):
-        if (self.debug):
-            print('\tyield_')
-        # stub
+        self.suspended = True
 
     def twobyte(self):
-        if (self.debug):
-            print('\ttwobyte')
-        # stub
+        pass  # stub
 
     def terminate(self):
         self.pixels.shutdown()
         self.reset()
 
+# state of the program just before an instruction executes
+TraceRecord = namedtuple("TraceRecord", ["pc", "instruction", "stack", "timestamp"])
+
+class TracedProgram(Program):
+    """Program that records every executed instruction into a ring buffer.
+
+    The newest trace_size records are kept in self.trace; it takes the place
+    of a debug switch on Program.
+    """
+
+    def __init__(self, name: str, data: bytes, pixels = None,
+                 max_depth: int = MAX_STACK_DEPTH, cache = None, clock = None,
+                 trace_size: int = 1024):
+        self.trace = deque(maxlen=trace_size)
+        super().__init__(name, data, pixels=pixels, max_depth=max_depth,
+                         cache=cache, clock=clock)
+
+    def step(self):
+        self.trace.append(TraceRecord(
+            pc=self.pc,
+            instruction=self.data[self.pc],
+            stack=tuple(self.stack[:self.sp]),
+            timestamp=perf_counter(),
+        ))
+        super().step()
+
+    def format_trace(self):
+        return "\n".join(
+            f"{record.timestamp:.6f}\tpc: {record.pc} ({hex(record.pc)})"
+            f"\tinst: {hex(record.instruction)}\tstack: {list(record.stack)}"
+            for record in self.trace
+        )
+
 if __name__ == "__main__":
     
     try:
@@ -545,12 +602,12 @@ if __name__ == "__main__":
         program = Program(
             name = name,
             data = data,
-            debug = False,
         )
 
         program.running = True
 
         program.execute()
+        program.terminate()
 
     except KeyboardInterrupt:
         program.terminate()
@@ -0,0 +1,9 @@
+start:
+# rainbow wave moving along the strip, one hue_gradient per frame
+  get_precise_time
+  PUSHB 0x64
+  hue_gradient
+  show
+  PUSHB 0xa
+  sleep
+  JMP start
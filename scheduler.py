@@ -0,0 +1,110 @@
+from time import perf_counter
+
+from pixels import Segment
+
+
+class Zone:
+    """A program running on one segment of the strip."""
+
+    def __init__(self, name, program):
+        self.name = name
+        self.program = program
+
+    @property
+    def segment(self):
+        return self.program.pixels
+
+
+class Scheduler:
+    """Interleaves the programs of several zones on one strip, in one thread.
+
+    Each call to run() gives every running zone one slice in turn and then
+    composes the segments into the strip's framebuffer (a FrameGovernor),
+    showing it once if any segment changed. A zone whose program fails or
+    stops does not affect the others.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.zones = {}  # name -> Zone, in the order they were added
+
+    def add(self, name, program):
+        if not isinstance(program.pixels, Segment):
+            raise ValueError(f"Zone {name} must draw on a Segment.")
+        self.zones[name] = Zone(name, program)
+
+    # the first zone, whose program stands for the strip in single-zone APIs
+    def primary(self):
+        return next(iter(self.zones.values()))
+
+    def running(self):
+        return any(zone.program.running for zone in self.zones.values())
+
+    # run one slice of every zone, returning (instructions executed,
+    # {zone: (state, error)} for the zones that stopped or failed)
+    def run(self, max_instructions, seconds):
+        executed = 0
+        changes = {}
+        for zone in self.zones.values():
+            program = zone.program
+            if not program.running:
+                continue
+            try:
+                executed += program.run_slice(
+                    max_instructions=max_instructions,
+                    deadline=perf_counter() + seconds,
+                )
+            except Exception as error:
+                program.halt()
+                changes[zone.name] = ("error", f"{type(error).__name__}: {error}")
+            else:
+                if not program.running:
+                    changes[zone.name] = ("stopped", None)
+        self.compose()
+        return executed, changes
+
+    # copy finished segments into the canvas and show it once
+    def compose(self):
+        composed = False
+        for zone in self.zones.values():
+            composed = zone.segment.compose(self.canvas) or composed
+        if composed:
+            self.canvas.show()
+        return composed
+
+    # seconds until the next zone wakes up, or None if none is running
+    def wake_delay(self):
+        now = perf_counter()
+        delays = [
+            max(0.0, zone.program.wake_time - now)
+            for zone in self.zones.values()
+            if zone.program.running
+        ]
+        return min(delays, default=None)
+
+
+def parse_zones(spec, length):
+    """Zones from a "name:start:length,..." spec, as [(name, start, length)].
+
+    An empty spec is one zone named "strip" covering the whole strip. Zones
+    must lie within the strip and must not overlap.
+    """
+    if not spec:
+        return [("strip", 0, length)]
+    zones = []
+    for part in spec.split(","):
+        try:
+            name, start, size = part.strip().split(":")
+            start, size = int(start), int(size)
+        except ValueError as error:
+            raise ValueError(f"Invalid zone {part!r}, expected name:start:length.") from error
+        if not name or size <= 0 or start < 0 or start + size > length:
+            raise ValueError(f"Zone {part!r} does not fit a strip of {length} pixels.")
+        zones.append((name, start, size))
+    ordered = sorted(zones, key=lambda zone: zone[1])
+    for (name, start, size), following in zip(ordered, ordered[1:]):
+        if start + size > following[1]:
+            raise ValueError(f"Zones {name} and {following[0]} overlap.")
+    if len({name for name, start, size in zones}) != len(zones):
+        raise ValueError("Zone names must be unique.")
+    return zones
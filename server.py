@@ -1,35 +1,313 @@
-from flask import Flask, request, abort, render_template
+from flask import Flask, Response, request, abort, render_template
 from flask_restful import Resource, Api
 from multiprocessing import Process, Pipe
-from ctypes import c_bool
+from multiprocessing.connection import wait
+from multiprocessing.sharedctypes import RawValue
+from ctypes import Structure, c_bool, c_double, c_long
+from threading import Lock, Thread
+from queue import Queue, Empty
+from time import perf_counter, time
 import re, os, subprocess
 
-from program import Program
-from pixels import Pixels
+from pixels import Pixels, Segment, BACKENDS, DEFAULT_BACKEND
+from governor import FrameGovernor
+from scheduler import Scheduler, parse_zones
+from engines import ENGINES, DEFAULT_ENGINE
+from cache import ProgramCache, DEFAULT_CACHE_BYTES
+from store import ProgramStore
+from profiler import ProfiledProgram, report
+from program import TracedProgram
+from feed import SharedFrame, events, FEED_FPS
+from optimizer import optimize
+from verifier import VerifyError, mnemonic, verify
+from sync import SyncClock, Leader, Follower, SYNC_PORT, parse_peers
+
+Engine = ENGINES[os.environ.get("LUMINA_ENGINE", DEFAULT_ENGINE)]
+Backend = BACKENDS[os.environ.get("LUMINA_BACKEND", DEFAULT_BACKEND)]
+
+SLICE_INSTRUCTIONS = 1000  # instructions per slice between control checks
+SLICE_SECONDS = 0.005  # longest a slice may run before control is checked
+# decoded programs kept by the worker
+PROGRAM_CACHE_BYTES = int(os.environ.get("LUMINA_CACHE_BYTES", DEFAULT_CACHE_BYTES))
+TARGET_FPS = float(os.environ.get("LUMINA_FPS", 60))  # strip refresh rate
+STRIP_LENGTH = 150
+OPTIMIZE = os.environ.get("LUMINA_OPTIMIZE", "1") != "0"  # optimize uploads
+METRICS_SECONDS = 1.0  # window over which the worker's rates are measured
+ZONES = parse_zones(os.environ.get("LUMINA_ZONES", ""), STRIP_LENGTH)
+SYNC = os.environ.get("LUMINA_SYNC", "")  # "leader", "follower" or off
+if SYNC not in ("", "leader", "follower"):
+    raise ValueError(f"Invalid LUMINA_SYNC {SYNC!r}, expected leader or follower.")
+SYNC_PORT = int(os.environ.get("LUMINA_SYNC_PORT", SYNC_PORT))  # followers listen here
+SYNC_PEERS = parse_peers(  # where the leader sends its beats
+    os.environ.get("LUMINA_SYNC_PEERS", f"255.255.255.255:{SYNC_PORT}")
+)
+
+
+class Metrics(Structure):
+    """Counters published by the worker for /status.
+
+    The block lives in shared memory without a lock: the worker is the only
+    writer, and a reader may see fields from two neighbouring updates. Rates
+    and loads cover the last complete METRICS_SECONDS window and all zones;
+    loads are the fraction of that window spent in the activity. pc and
+    stack_depth are those of the first zone's program.
+    """
+
+    _fields_ = [
+        ("pc", c_long),
+        ("stack_depth", c_long),
+        ("instructions_per_second", c_double),
+        ("frames_per_second", c_double),
+        ("show_load", c_double),  # writing frames to the strip
+        ("sleep_load", c_double),  # waiting for a wake time or a message
+        ("switched", c_double),  # time() of the last program switch
+        ("clock_offset", c_double),  # follower's clock less the local one
+    ]
 
 
 class ProgramProcess(Process):
-    def __init__(self, name, data):
+    """Long-lived worker that owns the strip and runs a program on each zone.
+
+    Every zone of the strip gets its own Program drawing on a Segment, and
+    a single Scheduler interleaves them, composing their frames into one
+    show per frame. The server only ever sends ("load", zone, name, bytecode)
+    messages (zone None for all of them), which the worker swaps into that
+    zone's Program in place, so switching programs neither pickles a Program
+    nor re-initialises the hardware, and ("profile",) and ("trace",) requests
+    for the counts of a profiled program and the records of a traced one.
+    The worker answers with ("state", {zone: status}), ("profile", counts)
+    and ("trace", records) messages, which a thread in the server reads as
+    they arrive so that the worker never blocks sending them.
+    """
+
+    def __init__(self, name, data, zones=ZONES):
         super().__init__()
         self.pipe_in, self.pipe_out = Pipe()
-        self.program = Program(name=name, data=data, pixels=Pixels())
+        self.initial = (name, data)
+        self.zones = zones  # [(name, start, length)]
+        self.scheduler = None  # created in the worker, see run()
+        self.status = {
+            zone: {"program": name, "state": "running", "error": None}
+            for zone, start, length in zones
+        }
+        self.status_lock = Lock()  # guards status and sending on the pipe
+        self.replies = Queue()  # answers to ("profile",) and ("trace",)
+        self.request_lock = Lock()  # one request at a time
+        self.metrics = RawValue(Metrics)
+        self.feed = SharedFrame(STRIP_LENGTH)  # what the strip shows
+
+    def start(self):
+        super().start()
+        Thread(target=self.listen, daemon=True).start()
+
+    # runs in a server thread: apply the worker's messages as they arrive
+    def listen(self):
+        while True:
+            try:
+                kind, message = self.pipe_in.recv()
+            except EOFError:
+                return  # the worker has exited
+            if kind == "state":
+                with self.status_lock:
+                    self.status.update(message)
+            else:
+                self.replies.put(message)
+
+    # runs in the server: replace the program running on zone (on every
+    # zone if None)
+    def load(self, name, data, zone=None):
+        with self.status_lock:
+            self.pipe_in.send(("load", zone, name, bytes(data)))
+
+    # runs in the server: latest state reported by the worker for zone (the
+    # first zone if None)
+    def state(self, zone=None):
+        with self.status_lock:
+            return self.status[zone if zone is not None else self.zones[0][0]]
+
+    # runs in the server: latest state of every zone
+    def states(self):
+        with self.status_lock:
+            return dict(self.status)
+
+    # runs in the server: send the worker a request and wait for its answer,
+    # None if it does not come within timeout
+    def request(self, kind, timeout=1.0):
+        with self.request_lock:
+            # answers that arrived after their request timed out are dropped
+            while not self.replies.empty():
+                self.replies.get_nowait()
+            with self.status_lock:
+                self.pipe_in.send((kind,))
+            try:
+                return self.replies.get(timeout=timeout)
+            except Empty:
+                return None
+
+    # runs in the server: (name, bytecode, counts) of the first zone's program
+    # if the worker is profiling it, otherwise None
+    def profile(self):
+        return self.request("profile")
+
+    # runs in the server: the first zone's newest trace records, oldest
+    # first, if the worker is tracing it, otherwise None
+    def trace(self):
+        return self.request("trace")
+
+    # runs in the server: current metrics, read without waiting on the worker
+    def measurements(self):
+        metrics = self.metrics
+        return {
+            "pc": metrics.pc,
+            "stack_depth": metrics.stack_depth,
+            "instructions_per_second": metrics.instructions_per_second,
+            "frames_per_second": metrics.frames_per_second,
+            "show_load": metrics.show_load,
+            "sleep_load": metrics.sleep_load,
+            "seconds_since_switch": time() - metrics.switched if metrics.switched else None,
+            "sync": SYNC or None,
+            "clock_offset": metrics.clock_offset,
+        }
+
+    # runs in the worker: tell the server what the programs are doing, given
+    # {zone: (state, error)}
+    def report(self, states):
+        zones = self.scheduler.zones
+        self.pipe_out.send(("state", {
+            zone: {"program": zones[zone].program.name, "state": state, "error": error}
+            for zone, (state, error) in states.items()
+        }))
+
+    # runs in the worker: load a program on zone (every zone if None);
+    # zones this controller does not have are ignored, and a zone whose
+    # program cannot be loaded keeps running its previous one
+    def switch(self, zone, name, data):
+        zones = self.scheduler.zones
+        names = list(zones) if zone is None else [zone] if zone in zones else []
+        states = {}
+        for zone in names:
+            try:
+                zones[zone].program.load(name, data)
+            except Exception as error:
+                states[zone] = ("running", f"Could not load {name}: {type(error).__name__}: {error}")
+                continue
+            zones[zone].segment.reset()
+            states[zone] = ("running", None)
+        if states:
+            self.report(states)
+        if any(error is None for state, error in states.values()):
+            self.metrics.switched = time()
+
+    # runs in the worker: counts of a profiled program
+    def counts(self):
+        program = self.scheduler.primary().program
+        if not hasattr(program, "counts"):
+            return None
+        return (program.name, bytes(program.data), program.counts)
+
+    # runs in the worker: trace records of a traced program
+    def records(self):
+        program = self.scheduler.primary().program
+        if not hasattr(program, "trace"):
+            return None
+        return [
+            {
+                "pc": record.pc,
+                "instruction": mnemonic(record.instruction),
+                "stack": list(record.stack),
+                "timestamp": record.timestamp,
+            }
+            for record in program.trace
+        ]
 
     def run(self):
+        name, data = self.initial
+        clock = SyncClock()  # stays the local clock unless following
+        leader = Leader(SYNC_PEERS) if SYNC == "leader" else None
+        follower = Follower(SYNC_PORT, clock) if SYNC == "follower" else None
+        pixels = FrameGovernor(
+            Pixels(STRIP_LENGTH, backend=Backend()),
+            fps=TARGET_FPS,
+            feed=self.feed,
+            clock=clock.time if SYNC else None,  # show on shared frame boundaries
+        )
+        pixels.start()
+        cache = ProgramCache(PROGRAM_CACHE_BYTES)  # shared by all zones
+        self.scheduler = Scheduler(pixels)
+        for zone, start, length in self.zones:
+            self.scheduler.add(zone, Engine(
+                name=name,
+                data=data,
+                pixels=Segment(start, length),
+                cache=cache,
+                clock=clock.time,
+            ))
+        self.report({zone: ("running", None) for zone in self.scheduler.zones})
+        if leader is not None:
+            leader.switch(None, name, data)
+        sources = [self.pipe_out] + ([follower] if follower is not None else [])
+        self.metrics.switched = time()
+        window = perf_counter()
+        executed, slept = 0, 0.0
+        frames, shown = pixels.frames, pixels.show_seconds
         while True:
-            if self.program and self.program.running:
-                self.program.step()
-            if self.pipe_out.poll():
-                self.program = self.pipe_out.recv()
-                assert type(self.program) == Program
+            now = perf_counter()
+            if now - window >= METRICS_SECONDS:
+                # rates over the window just ended, then start the next one
+                elapsed = now - window
+                metrics = self.metrics
+                metrics.instructions_per_second = executed / elapsed
+                metrics.frames_per_second = (pixels.frames - frames) / elapsed
+                metrics.show_load = (pixels.show_seconds - shown) / elapsed
+                metrics.sleep_load = slept / elapsed
+                window = now
+                executed, slept = 0, 0.0
+                frames, shown = pixels.frames, pixels.show_seconds
+            # wake up at the end of the window even when idle
+            timeout = max(0.0, window + METRICS_SECONDS - now)
+            if self.scheduler.running():
+                count, changes = self.scheduler.run(SLICE_INSTRUCTIONS, SLICE_SECONDS)
+                executed += count
+                if changes:
+                    self.report(changes)
+                # sleeping programs are resumed by the poll timeout
+                delay = self.scheduler.wake_delay()
+                if delay is not None:
+                    timeout = min(timeout, delay)
+                program = self.scheduler.primary().program
+                self.metrics.pc = program.pc
+                self.metrics.stack_depth = program.sp
+            if leader is not None:
+                if not leader.beat_delay():
+                    leader.beat()
+                timeout = min(timeout, leader.beat_delay())
+            start = perf_counter()
+            ready = wait(sources, timeout)
+            slept += perf_counter() - start
+            if follower in ready:
+                for zone, name, data in follower.receive():
+                    self.switch(zone, name, data)
+                self.metrics.clock_offset = clock.offset
+            if self.pipe_out in ready:
+                kind, *message = self.pipe_out.recv()
+                if kind == "load":
+                    zone, name, data = message
+                    self.switch(zone, name, data)
+                    if leader is not None:
+                        leader.switch(zone, name, data)
+                elif kind == "profile":
+                    self.pipe_out.send(("profile", self.counts()))
+                elif kind == "trace":
+                    self.pipe_out.send(("trace", self.records()))
 
 
-binaries = {}
 BUILTIN = ["idle", "rainbow", "life"]
-for name in BUILTIN:
-    with open(f"programs/{name}.bin", "rb") as binary:
-        binaries[name] = binary.read()
+store = ProgramStore(
+    os.environ.get("LUMINA_STORE", "store"),
+    builtin={name: f"programs/{name}.bin" for name in BUILTIN},
+)
 
-current = ProgramProcess(name="idle", data=binaries["idle"])
+current = ProgramProcess(name="idle", data=bytes(store.get("idle")))
 
 app = Flask(__name__)
 api = Api(app)
@@ -40,22 +318,68 @@ def index():
     return render_template("index.html")
 
 
+# GET /frames?fps=<rate>
+# stream the frames shown on the strip as server-sent events
+@app.route("/frames")
+def frames():
+    global current
+    fps = min(max(request.args.get("fps", FEED_FPS, type=float), 1.0), TARGET_FPS)
+    return Response(
+        events(current.feed, fps),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+# assembler source of a builtin program, for mapping profiles to lines
+def source(name):
+    if name not in BUILTIN:
+        return None
+    with open(f"programs/{name}.asm", "r") as sourcefile:
+        return sourcefile.read()
+
+
 class StatusResource(Resource):
     # GET /status/
-    # get server status
+    # get server status and live metrics from the worker, with a profile
+    # when LUMINA_ENGINE=profiled; program and state are the first zone's
     def get(self):
-        return f"GET /status"
+        global current
+        status = dict(current.state(), **current.measurements(), zones=current.states())
+        # only a profiled program has counts worth the round trip to the worker
+        profile = current.profile() if issubclass(Engine, ProfiledProgram) else None
+        if profile is not None:
+            name, data, counts = profile
+            status["profile"] = report(data, counts, source=source(name))
+        return status
 
 
 api.add_resource(StatusResource, "/status")
 
 
+class TraceResource(Resource):
+    # GET /trace
+    # get the instructions the first zone's program executed most recently,
+    # when LUMINA_ENGINE=traced
+    def get(self):
+        global current
+        if not issubclass(Engine, TracedProgram):
+            abort(404, "Tracing is off, set LUMINA_ENGINE=traced.")
+        records = current.trace()
+        if records is None:
+            abort(503, "The worker did not answer.")
+        return {"program": current.state()["program"], "trace": records}
+
+
+api.add_resource(TraceResource, "/trace")
+
+
 class ProgramsResource(Resource):
     # GET /programs
     # list all programs
     def get(self):
-        global binaries
-        return {"programs": list(binaries.keys())}
+        global store
+        return {"programs": store.names()}
 
 
 api.add_resource(ProgramsResource, "/programs")
@@ -65,29 +389,43 @@ class ModifyProgramResource(Resource):
     # GET /programs/<name>
     # download a program
     def get(self, name):
-        global binaries
-        if name not in binaries:
+        global store
+        if name not in store:
             abort(404, "Program not found.")
-        return binaries[name]
+        return Response(bytes(store.get(name)), mimetype="application/octet-stream")
 
     # POST /programs/<name>
-    # upload a program
+    # upload a program, returning the optimizer's report; programs that the
+    # verifier cannot prove safe are rejected
     def post(self, name):
-        global binaries
+        global store
         if not request.data:
             abort(400, "Binary data required.")
-        if name in BUILTIN:
+        if store.is_builtin(name):
             abort(403, f"Program {name} cannot be modified.")
-        binaries[name] = request.data
-        return "", 204
+        try:
+            verify(request.data)
+        except VerifyError as error:
+            abort(400, f"Program rejected: {error}")
+        if not OPTIMIZE:
+            store.put(name, request.data)
+            return "", 204
+        data, report = optimize(request.data)
+        store.put(name, data)
+        return report
 
     # DELETE /programs/<name>
     # delete a program
     def delete(self, name):
-        global binaries
-        if name not in binaries:
+        global store
+        if name not in store:
+            abort(404, "The program does not exist.")
+        if store.is_builtin(name):
+            abort(403, f"Program {name} cannot be modified.")
+        try:
+            store.delete(name)
+        except KeyError:
             abort(404, "The program does not exist.")
-        del binaries[name]
         return "", 204
 
 
@@ -96,10 +434,10 @@ api.add_resource(ModifyProgramResource, "/programs/<string:name>")
 
 class ExecuteResource(Resource):
     # GET /execute
-    # get running program name
+    # get running program name and state
     def get(self):
         global current
-        return current.program.name
+        return current.state()
 
 
 api.add_resource(ExecuteResource, "/execute")
@@ -107,39 +445,90 @@ api.add_resource(ExecuteResource, "/execute")
 
 class ExecuteProgramResource(Resource):
     # POST /execute/<name>
-    # set running program
+    # set running program on every zone
     def post(self, name):
-        global binaries, current
-        if name not in binaries:
+        global store, current
+        try:
+            data = store.get(name)
+        except KeyError:
             abort(404, "The program does not exist.")
-        current.pipe_in.send(Program(name=name, data=binaries[name], pixels=Pixels()))
+        current.load(name, data)
         return "", 204
 
 
 api.add_resource(ExecuteProgramResource, "/execute/<string:name>")
 
 
+class ZonesResource(Resource):
+    # GET /zones
+    # list the zones of the strip and the program running on each
+    def get(self):
+        global current
+        states = current.states()
+        return {
+            "zones": [
+                dict(states[zone], name=zone, start=start, length=length)
+                for zone, start, length in current.zones
+            ]
+        }
+
+
+api.add_resource(ZonesResource, "/zones")
+
+
+def zone_names():
+    return [zone for zone, start, length in current.zones]
+
+
+class ZoneExecuteResource(Resource):
+    # GET /zones/<zone>/execute
+    # get the name and state of the program running on a zone
+    def get(self, zone):
+        global current
+        if zone not in zone_names():
+            abort(404, "The zone does not exist.")
+        return current.state(zone)
+
+
+api.add_resource(ZoneExecuteResource, "/zones/<string:zone>/execute")
+
+
+class ZoneExecuteProgramResource(Resource):
+    # POST /zones/<zone>/execute/<name>
+    # set running program on one zone
+    def post(self, zone, name):
+        global store, current
+        if zone not in zone_names():
+            abort(404, "The zone does not exist.")
+        try:
+            data = store.get(name)
+        except KeyError:
+            abort(404, "The program does not exist.")
+        current.load(name, data, zone)
+        return "", 204
+
+
+api.add_resource(ZoneExecuteProgramResource, "/zones/<string:zone>/execute/<string:name>")
+
+
 class ColorResource(Resource):
     color_pattern = re.compile(r"^[0-9a-f]{6}$")
 
     # POST /color/<value>
     # set running program to run solid color
     def post(self, value):
-        global binaries, current
+        global current
         if not ColorResource.color_pattern.match(value):
             abort(404, "Invalid color code.")
         value = int(value, 16)
         r, g, b = ((value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF)
-        current.pipe_in.send(
-            Program(
-                name="color",
-                data=bytes([
-                    0x31,    r,    g,    b,
-                    0x00, 0xe7, 0x11, 0x0a,
-                    0xf9, 0x40, 0x06, 0x00
-                ]),
-                pixels=Pixels(),
-            )
+        current.load(
+            "color",
+            bytes([
+                0x31,    r,    g,    b,
+                0x00, 0xe7, 0x11, 0x0a,
+                0xf9, 0x40, 0x06, 0x00
+            ]),
         )
         return "", 204
 
@@ -149,16 +538,18 @@ api.add_resource(ColorResource, "/color/<string:value>")
 if __name__ == "__main__":
     current.start()
     app.secret_key = os.urandom(12)
-    try:
-        host = (
-            subprocess.check_output(["/bin/hostname", "-I"])
-            .split()[0]
-            .strip()
-            .decode("utf-8")
-        )
-    except IndexError:
-        raise Exception(subprocess.check_output(["/bin/hostname", "-I"]))
+    host = os.environ.get("LUMINA_HOST")
+    if not host:
+        try:
+            host = (
+                subprocess.check_output(["/bin/hostname", "-I"])
+                .split()[0]
+                .strip()
+                .decode("utf-8")
+            )
+        except IndexError:
+            raise Exception(subprocess.check_output(["/bin/hostname", "-I"]))
     print("Host:", host)  # Right now this breaks under Darnell wifi
     app.run(
-        debug=False, use_reloader=False, host=host, port=8010
+        debug=False, use_reloader=False, host=host, port=int(os.environ.get("LUMINA_PORT", 8010))
     )  # change use_reloader to True when running
@@ -0,0 +1,126 @@
+import json
+import mmap
+import os
+import tempfile
+from hashlib import sha256
+from threading import Lock
+
+
+class StoreError(Exception):
+    pass
+
+
+class ProgramStore:
+    """Directory of uploaded program binaries with a JSON index.
+
+    Each binary is stored once under the hash of its contents and the index
+    maps program names to those files. Writes go to a temporary file that is
+    atomically renamed into place, so readers never see a partial program,
+    and the lock is only held while the index itself changes. Binaries are
+    memory-mapped the first time they are read instead of being loaded at
+    startup.
+    """
+
+    INDEX = "index.json"
+
+    def __init__(self, directory: str, builtin: dict = None):
+        self.directory = directory
+        self.builtin = dict(builtin or {})  # name -> path, read-only
+        self.lock = Lock()
+        self.mapped = {}  # path -> mmap (or b"" for empty files)
+        os.makedirs(directory, exist_ok=True)
+        self.index = self.read_index()
+
+    def read_index(self):
+        path = os.path.join(self.directory, ProgramStore.INDEX)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r") as index:
+            return json.load(index)["programs"]
+
+    def write_atomic(self, filename, data):
+        descriptor, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp, os.path.join(self.directory, filename))
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def save_index(self):
+        data = json.dumps({"programs": self.index}, indent=2, sort_keys=True)
+        self.write_atomic(ProgramStore.INDEX, data.encode("utf-8"))
+
+    def path(self, name):
+        if name in self.builtin:
+            return self.builtin[name]
+        return os.path.join(self.directory, self.index[name]["file"])
+
+    def names(self):
+        with self.lock:
+            return list(self.builtin) + [
+                name for name in self.index if name not in self.builtin
+            ]
+
+    def is_builtin(self, name):
+        return name in self.builtin
+
+    def __contains__(self, name):
+        return name in self.builtin or name in self.index
+
+    # read-only view of a program's bytes, mapped on first use
+    def get(self, name):
+        with self.lock:
+            if name not in self:
+                raise KeyError(name)
+            path = self.path(name)
+            if path not in self.mapped:
+                with open(path, "rb") as file:
+                    if os.fstat(file.fileno()).st_size == 0:
+                        self.mapped[path] = b""  # empty files cannot be mapped
+                    else:
+                        self.mapped[path] = mmap.mmap(
+                            file.fileno(), 0, access=mmap.ACCESS_READ
+                        )
+            return self.mapped[path]
+
+    def put(self, name, data):
+        if name in self.builtin:
+            raise StoreError(f"Program {name} cannot be modified.")
+        digest = sha256(data).hexdigest()
+        filename = f"{digest}.bin"
+        if not os.path.exists(os.path.join(self.directory, filename)):
+            self.write_atomic(filename, data)
+        with self.lock:
+            # a concurrent delete may have released an identical binary
+            if not os.path.exists(os.path.join(self.directory, filename)):
+                self.write_atomic(filename, data)
+            previous = self.index.get(name)
+            self.index[name] = {"file": filename, "size": len(data), "sha256": digest}
+            self.save_index()
+            if previous is not None:
+                self.release(previous["file"])
+
+    def delete(self, name):
+        if name in self.builtin:
+            raise StoreError(f"Program {name} cannot be modified.")
+        with self.lock:
+            if name not in self.index:
+                raise KeyError(name)
+            entry = self.index.pop(name)
+            self.save_index()
+            self.release(entry["file"])
+
+    # remove a binary no longer referenced by the index, lock held
+    def release(self, filename):
+        if any(entry["file"] == filename for entry in self.index.values()):
+            return
+        path = os.path.join(self.directory, filename)
+        self.mapped.pop(path, None)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,235 @@
+import json, os, socket, sys
+from base64 import b64decode, b64encode
+from collections import deque
+from hashlib import sha256
+from time import time
+
+from verifier import VerifyError, verify
+
+# Frame synchronisation between controllers on one installation. One
+# controller is the leader: its worker sends a beat over UDP every
+# BEAT_SECONDS, and straight away whenever it switches programs. A beat
+# carries the leader's wall clock and the latest program switch of each of
+# its zones, naming the bytecode by its hash; the bytecode itself follows in
+# separate chunk packets, sent with the switch and again every BODY_BEATS
+# beats, so a follower that missed a switch or started late catches up.
+# Followers shift their wall clock onto the leader's, which both lines up
+# get_wall_time and get_precise_time and lets every FrameGovernor write
+# frames on the same shared frame boundaries.
+
+SYNC_PORT = 7010  # port followers listen on by default
+BEAT_SECONDS = 0.5  # time between beats
+BODY_BEATS = 4  # beats between repeats of the bytecode
+CLOCK_SAMPLES = 8  # beats the clock offset is estimated from
+CHUNK_BYTES = 32768  # bytecode per chunk packet, well within a datagram
+MAX_PACKET = 65507  # largest UDP payload
+RECEIVE_BUFFER = 1024 * 1024  # follower socket buffer, capped by the kernel
+
+
+def digest(data):
+    return sha256(data).hexdigest()
+
+
+class SyncClock:
+    """Wall clock in seconds shared by synchronised controllers.
+
+    The offset to the local clock is estimated from the leader's beats.
+    Each sample is the leader's time less the local time when its beat
+    arrived, which falls short of the true offset by the network delay; the
+    largest of the recent samples is the one that was delayed least.
+    """
+
+    def __init__(self):
+        self.offset = 0.0
+        self.samples = deque(maxlen=CLOCK_SAMPLES)
+
+    def time(self):
+        return time() + self.offset
+
+    def sample(self, leader_time):
+        self.samples.append(leader_time - time())
+        self.offset = max(self.samples)
+
+
+# host:port pairs from a comma-separated list
+def parse_peers(spec):
+    peers = []
+    for part in spec.split(","):
+        host, _, port = part.strip().rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(f"Invalid sync peer {part!r}, expected host:port.")
+        peers.append((host, int(port)))
+    return peers
+
+
+class Leader:
+    """Sends beats with the clock and program switches to the followers.
+
+    peers are (host, port) addresses, a broadcast address to reach every
+    follower on the network or each follower's own address.
+    """
+
+    def __init__(self, peers):
+        self.peers = peers
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.epoch = os.urandom(4).hex()  # tells followers the leader restarted
+        self.sequence = 0
+        self.switches = {}  # zone (None for all) -> (sequence, name, digest)
+        self.bodies = {}  # digest -> bytecode of the current switches
+        self.beats = 0
+        self.last_beat = 0.0
+        self.failing = False  # whether the last send failed
+
+    # record a switch of zone (every zone if None) and announce it at once
+    def switch(self, zone, name, data):
+        self.sequence += 1
+        if zone is None:
+            self.switches.clear()  # replaces every earlier switch
+        data = bytes(data)
+        self.switches[zone] = (self.sequence, name, digest(data))
+        self.bodies = {
+            key: self.bodies.get(key, data)
+            for key in {key for sequence, name, key in self.switches.values()}
+        }
+        self.beat()
+        self.send_body(digest(data))
+
+    def beat(self):
+        self.send({
+            "epoch": self.epoch,
+            "time": time(),
+            "switches": [
+                [sequence, zone, name, key]
+                for zone, (sequence, name, key) in self.switches.items()
+            ],
+        })
+        self.beats += 1
+        if self.beats % BODY_BEATS == 0:
+            for key in self.bodies:
+                self.send_body(key)
+        self.last_beat = time()
+
+    # send the bytecode with the given digest in chunk packets
+    def send_body(self, key):
+        data = self.bodies[key]
+        chunks = max(1, -(-len(data) // CHUNK_BYTES))
+        for chunk in range(chunks):
+            self.send({
+                "program": key,
+                "chunk": chunk,
+                "chunks": chunks,
+                "data": b64encode(data[chunk * CHUNK_BYTES : (chunk + 1) * CHUNK_BYTES]).decode("ascii"),
+            })
+
+    # an unreachable follower must not stop the leader, but a leader that
+    # cannot send at all is reported once rather than on every beat
+    def send(self, message):
+        packet = json.dumps(message).encode("utf-8")
+        failed = None
+        for peer in self.peers:
+            try:
+                self.socket.sendto(packet, peer)
+            except OSError as error:
+                failed = error
+        if failed is not None and not self.failing:
+            print(f"Sync: sending {len(packet)} bytes failed: {failed}", file=sys.stderr)
+        self.failing = failed is not None
+
+    # seconds until the next beat is due
+    def beat_delay(self):
+        return max(0.0, self.last_beat + BEAT_SECONDS - time())
+
+
+class Follower:
+    """Receives the leader's beats and bytecode on a UDP port.
+
+    The socket can be waited on with multiprocessing.connection.wait, so a
+    worker can watch it alongside its pipe. Bytecode is only handed on once
+    it has arrived in full, matches its hash and passes the verifier.
+    """
+
+    def __init__(self, port=SYNC_PORT, clock=None):
+        self.clock = clock if clock is not None else SyncClock()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # room for a few programs' chunks arriving between two receives
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        self.socket.bind(("", port))
+        self.socket.setblocking(False)
+        self.epoch = None
+        self.sequence = 0  # newest switch applied
+        self.pending = {}  # sequence -> (zone, name, digest) awaiting bytecode
+        self.chunks = {}  # digest -> {chunk: bytes} of bytecode being received
+        self.bodies = {}  # digest -> bytecode received in full
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    # read every pending packet, updating the clock, and return the switches
+    # not seen before as [(zone, name, data)] in the order they were made
+    def receive(self):
+        while True:
+            try:
+                packet = self.socket.recv(MAX_PACKET)
+            except BlockingIOError:
+                break
+            try:
+                message = json.loads(packet)
+                if "program" in message:
+                    self.chunk(message)
+                else:
+                    self.beat(message)
+            except (ValueError, KeyError, TypeError):
+                continue  # not one of ours
+        return self.ready()
+
+    def beat(self, beat):
+        epoch, leader_time = beat["epoch"], float(beat["time"])
+        entries = beat["switches"]
+        if epoch != self.epoch:
+            self.epoch, self.sequence = epoch, 0
+            self.clock.samples.clear()
+        self.clock.sample(leader_time)
+        # a beat lists every switch still in force, so switches it no longer
+        # mentions were replaced and their bytecode will not be sent again
+        self.pending = {
+            sequence: (zone, name, key)
+            for sequence, zone, name, key in entries
+            if sequence > self.sequence
+        }
+        # keep only the bytecode the leader still announces
+        wanted = {key for zone, name, key in self.pending.values()}
+        self.chunks = {key: chunks for key, chunks in self.chunks.items() if key in wanted}
+        self.bodies = {key: data for key, data in self.bodies.items() if key in wanted}
+
+    def chunk(self, message):
+        key, chunk, count = message["program"], int(message["chunk"]), int(message["chunks"])
+        if key in self.bodies:
+            return
+        chunks = self.chunks.setdefault(key, {})
+        chunks[chunk] = b64decode(message["data"])
+        if len(chunks) == count:
+            del self.chunks[key]
+            data = b"".join(chunks[i] for i in range(count))
+            if digest(data) == key:
+                self.bodies[key] = data
+
+    # switches whose bytecode has arrived, in order; a switch still waiting
+    # for its bytecode holds back the ones after it
+    def ready(self):
+        switches = []
+        for sequence in sorted(self.pending):
+            zone, name, key = self.pending[sequence]
+            if key not in self.bodies:
+                break
+            del self.pending[sequence]
+            self.sequence = sequence
+            data = self.bodies[key]
+            try:
+                verify(data)
+            except VerifyError as error:
+                print(f"Sync: rejected {name}: {error}", file=sys.stderr)
+                continue
+            switches.append((zone, name, data))
+        return switches
@@ -0,0 +1,46 @@
+import os
+
+from pixels import Pixels, VirtualBackend
+
+PROGRAMS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "programs")
+# random.bin is committed empty; its unfinished source is not assembled
+BUNDLED = sorted(
+    name[:-4] for name in os.listdir(PROGRAMS)
+    if name.endswith(".bin") and os.path.getsize(os.path.join(PROGRAMS, name))
+)
+SLICES = 300  # slices each program is run for
+STRIP_LENGTH = 150
+
+
+def bytecode(name):
+    with open(os.path.join(PROGRAMS, f"{name}.bin"), "rb") as binary:
+        return binary.read()
+
+
+def source(name):
+    with open(os.path.join(PROGRAMS, f"{name}.asm"), "r") as sourcefile:
+        return sourcefile.read()
+
+
+def strip():
+    return Pixels(STRIP_LENGTH, backend=VirtualBackend())
+
+
+# run a program slice by slice, skipping its sleeps, on a clock that
+# advances by a fixed step per slice; returns the state after every slice
+# and the frames it showed
+def run(engine, data):
+    now = [1000.0]
+    backend = VirtualBackend(capacity=SLICES)
+    program = engine(name="test", data=data, pixels=Pixels(STRIP_LENGTH, backend=backend),
+                     clock=lambda: now[0])
+    states = []
+    for _ in range(SLICES):
+        if not program.running:
+            break
+        program.run_slice()
+        states.append((program.pc, program.stack[:program.sp], bytes(program.pixels.buffer)))
+        now[0] += 0.01
+        program.wake_time = 0.0  # skip the sleep itself
+    timestamps, frames = backend.recorded()
+    return states, frames.tolist()
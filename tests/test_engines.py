@@ -0,0 +1,38 @@
+import pytest
+
+from assembler import Assembler
+from compiler import CompiledProgram
+from engines import ENGINES
+from helpers import BUNDLED, bytecode, run, strip
+
+
+@pytest.mark.parametrize("name", BUNDLED)
+@pytest.mark.parametrize("engine", [engine for engine in ENGINES if engine != "interpreter"])
+def test_engine_matches_interpreter(engine, name):
+    data = bytecode(name)
+    expected = run(ENGINES["interpreter"], data)
+    assert expected[0], "the program did not run"
+    assert run(ENGINES[engine], data) == expected
+
+
+@pytest.mark.parametrize("name", BUNDLED)
+def test_bundled_programs_compile(name):
+    program = CompiledProgram(name=name, data=bytecode(name), pixels=strip())
+    assert program.compiled is not None
+
+
+# thousands of blocks, enough to overflow a flat if/elif dispatch
+def test_large_program_matches_interpreter():
+    lines = ["  PUSHB 0"]
+    for i in range(3000):
+        lines += [
+            "  INC", "  PEEK 0", "  PUSHB 7", "  AND", f"  JZ skip{i}",
+            "  DEC", f"skip{i}:", "  POP 1",
+        ]
+    lines += ["  exit"]
+    data = Assembler.assemble("\n".join(lines) + "\n")
+    program = CompiledProgram(name="large", data=data, pixels=strip())
+    assert program.compiled is not None
+    # compiled slices may overrun their budget by a block, so only the
+    # final states line up
+    assert run(CompiledProgram, data)[0][-1] == run(ENGINES["interpreter"], data)[0][-1]
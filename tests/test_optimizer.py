@@ -0,0 +1,47 @@
+import pytest
+
+from assembler import Assembler
+from helpers import BUNDLED, run, source
+from optimizer import optimize
+from threaded import ThreadedProgram
+from verifier import verify
+
+
+# what a program draws: the framebuffer after every slice and the frames
+# shown; pcs and slice lengths change when instructions are removed
+def drawing(data):
+    states, frames = run(ThreadedProgram, data)
+    return [framebuffer for pc, stack, framebuffer in states], frames
+
+
+@pytest.mark.parametrize("name", BUNDLED)
+@pytest.mark.parametrize("fuse", [True, False])
+def test_bundled_programs_behave_the_same(name, fuse):
+    data = Assembler.assemble(source(name), fuse)
+    optimized, report = optimize(data)
+    assert "skipped" not in report
+    assert len(optimized) <= len(data)
+    verify(optimized)
+    assert drawing(optimized) == drawing(data)
+
+
+def test_folds_constants():
+    data = Assembler.assemble("  PUSHW 5\n  PUSHW 3\n  ADD\n  POP 1\n  exit\n", fuse=False)
+    optimized, report = optimize(data)
+    assert optimized == bytes([0xfa])
+    assert report["rewrites"]["fold binary"] == 1
+    assert report["instructions_before"] == 5 and report["instructions_after"] == 1
+
+
+def test_unverifiable_programs_are_left_alone():
+    data = bytes([0x01, 0xfa])  # POP 1 on an empty stack
+    optimized, report = optimize(data)
+    assert optimized == data
+    assert report["skipped"].startswith("Possible stack underflow")
+
+
+def test_slow_optimizing_is_abandoned():
+    data = Assembler.assemble("  PUSHW 5\n  PUSHW 3\n  ADD\n  POP 1\n  exit\n", fuse=False)
+    optimized, report = optimize(data, seconds=-1)
+    assert optimized == data
+    assert report["skipped"] == "Optimizing took too long"
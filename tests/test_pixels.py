@@ -0,0 +1,137 @@
+import pytest
+
+from pixels import Framebuffer, Segment
+
+
+def test_segment_composes_finished_frames_only():
+    strip = Framebuffer(10)
+    segment = Segment(2, 4)
+    segment.set_pixel(1, 2, 3, 0)
+    segment.show()
+    assert segment.compose(strip)
+    assert strip.get_pixel(2) == (1, 2, 3)
+    strip.mark_clean()
+
+    segment.show()  # nothing changed since the last frame
+    segment.set_pixel(9, 9, 9, 1)  # partway through the next frame
+    assert not segment.compose(strip)
+    assert strip.get_pixel(3) == (0, 0, 0)
+    assert not strip.dirty()
+
+    segment.show()
+    assert segment.compose(strip)
+    assert strip.get_pixel(3) == (9, 9, 9)
+    assert (strip.dirty_start, strip.dirty_end) == (3, 4)
+
+
+# a clean strip of the given colours
+def framebuffer(*colours):
+    frame = Framebuffer(len(colours))
+    for i, colour in enumerate(colours):
+        frame.set_pixel(*colour, i)
+    frame.mark_clean()
+    return frame
+
+
+def pixels(frame):
+    return [frame.get_pixel(i) for i in range(frame.length())]
+
+
+def dirty_range(frame):
+    return frame.dirty_start, frame.dirty_end
+
+
+RED, GREEN, BLUE, BLACK = Framebuffer.RED, Framebuffer.GREEN, Framebuffer.BLUE, Framebuffer.BLACK
+
+
+def test_fill_pixels_clips_to_the_strip():
+    frame = framebuffer(RED, RED, RED, RED)
+    frame.fill_pixels(0, 0, 255, -2, 2)
+    assert pixels(frame) == [BLUE, BLUE, RED, RED]
+    assert dirty_range(frame) == (0, 2)
+
+    frame.mark_clean()
+    frame.fill_pixels(0, 255, 0, 3, 10)
+    assert pixels(frame) == [BLUE, BLUE, RED, GREEN]
+    assert dirty_range(frame) == (3, 4)
+
+
+def test_fill_pixels_outside_the_strip_changes_nothing():
+    frame = framebuffer(RED, RED)
+    frame.fill_pixels(0, 0, 255, 2, 5)
+    frame.fill_pixels(0, 0, 255, 1, 1)
+    frame.fill_pixels(255, 0, 0, 0, 2)  # already that colour
+    assert pixels(frame) == [RED, RED]
+    assert not frame.dirty()
+
+
+def test_shift_pixels_up_fills_with_black():
+    frame = framebuffer(RED, GREEN, BLUE, RED)
+    frame.shift_pixels(1)
+    assert pixels(frame) == [BLACK, RED, GREEN, BLUE]
+    assert dirty_range(frame) == (0, 4)
+
+
+def test_shift_pixels_down_fills_with_black():
+    frame = framebuffer(RED, GREEN, BLUE, RED)
+    frame.shift_pixels(-2)
+    assert pixels(frame) == [BLUE, RED, BLACK, BLACK]
+    assert dirty_range(frame) == (0, 4)
+
+
+@pytest.mark.parametrize("count", [4, 100, -4, -100])
+def test_shift_pixels_past_the_length_clears_the_strip(count):
+    frame = framebuffer(RED, GREEN, BLUE, RED)
+    frame.shift_pixels(count)
+    assert pixels(frame) == [BLACK] * 4
+    assert dirty_range(frame) == (0, 4)
+
+
+def test_shift_pixels_by_zero_changes_nothing():
+    frame = framebuffer(RED, GREEN, BLUE)
+    frame.shift_pixels(0)
+    assert pixels(frame) == [RED, GREEN, BLUE]
+    assert not frame.dirty()
+
+
+def test_rotate_pixels_wraps_around():
+    frame = framebuffer(RED, GREEN, BLUE, BLACK)
+    frame.rotate_pixels(1)
+    assert pixels(frame) == [BLACK, RED, GREEN, BLUE]
+    assert dirty_range(frame) == (0, 4)
+
+    frame.mark_clean()
+    frame.rotate_pixels(-2)
+    assert pixels(frame) == [GREEN, BLUE, BLACK, RED]
+    assert dirty_range(frame) == (0, 4)
+
+
+def test_rotate_pixels_by_the_length_changes_nothing():
+    frame = framebuffer(RED, GREEN, BLUE)
+    frame.rotate_pixels(3)
+    assert pixels(frame) == [RED, GREEN, BLUE]
+    assert not frame.dirty()
+
+
+@pytest.mark.parametrize("amount", [0, -10])
+def test_blend_pixels_by_nothing_changes_nothing(amount):
+    frame = framebuffer(RED, (10, 20, 30))
+    frame.blend_pixels(0, 0, 255, amount)
+    assert pixels(frame) == [RED, (10, 20, 30)]
+    assert not frame.dirty()
+
+
+@pytest.mark.parametrize("amount", [255, 1000])
+def test_blend_pixels_all_the_way_sets_the_colour(amount):
+    frame = framebuffer(RED, (10, 20, 30))
+    frame.blend_pixels(0, 0, 255, amount)
+    assert pixels(frame) == [BLUE, BLUE]
+    assert dirty_range(frame) == (0, 2)
+
+
+def test_blend_pixels_rounds_to_the_nearest_value():
+    frame = framebuffer((255, 0, 100))
+    frame.blend_pixels(0, 255, 100, 128)
+    # 255 * 127 / 255 = 127, 255 * 128 / 255 = 128
+    assert pixels(frame) == [(127, 128, 100)]
+    assert dirty_range(frame) == (0, 1)
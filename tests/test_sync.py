@@ -0,0 +1,44 @@
+import socket
+from multiprocessing.connection import wait
+
+from assembler import Assembler
+from sync import BODY_BEATS, CHUNK_BYTES, Follower, Leader
+from verifier import verify
+
+STEPS = 40000  # makes a program of three chunks
+
+
+# a program too long for one chunk packet that still passes the verifier
+def long_program():
+    lines = ["  PUSHB 0"] + ["  INC", "  DEC"] * STEPS + ["  POP 1"]
+    return Assembler.assemble("\n".join(lines) + "\n")
+
+
+def unused_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def test_late_follower_receives_long_program():
+    data = long_program()
+    assert len(data) > 2 * CHUNK_BYTES
+    port = unused_port()
+    leader = Leader([("127.0.0.1", port)])
+    leader.switch(None, "long", data)  # before the follower listens
+
+    follower = Follower(port)
+    switches = []
+    for _ in range(2 * BODY_BEATS):
+        leader.beat()
+        while wait([follower], timeout=0.05):  # read each packet as it arrives
+            switches += follower.receive()
+        if switches:
+            break
+    leader.socket.close()
+    follower.socket.close()
+
+    assert switches == [(None, "long", data)]
+    assert verify(switches[0][2])
+    # both ends share the local clock, so the offset is just the delay
+    assert abs(follower.clock.offset) < 0.05
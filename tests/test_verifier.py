@@ -0,0 +1,68 @@
+import pytest
+
+from helpers import BUNDLED, bytecode
+from program import MAX_STACK_DEPTH
+from verifier import VerifyError, verify
+
+PUSHZ, PUSHB, ADD, EXIT = 0x10, 0x11, 0x80, 0xfa
+
+
+def jump(op, target):
+    return bytes([op]) + target.to_bytes(2, "little")
+
+
+def JMP(target):
+    return jump(0x40, target)
+
+
+def JZ(target):
+    return jump(0x50, target)
+
+
+# (bytecode, pc at fault, words the message starts with)
+REJECTED = {
+    "underflow": (bytes([PUSHZ, ADD]), 1, "Possible stack underflow"),
+    "pop underflow": (bytes([0x01]), 0, "Possible stack underflow"),
+    "overflow": (bytes([PUSHZ] * (MAX_STACK_DEPTH + 1)), MAX_STACK_DEPTH, "Possible stack overflow"),
+    # PUSHZ; JZ 5; PUSHZ; EXIT joins at 5 with one item or two
+    "inconsistent depth": (bytes([PUSHZ]) + JZ(5) + bytes([PUSHZ, EXIT]), 5, "Inconsistent stack depth"),
+    # PUSHZ; JZ 5; PUSHB 0xfa; EXIT jumps to the immediate of PUSHB
+    "jump into instruction": (bytes([PUSHZ]) + JZ(5) + bytes([PUSHB, EXIT, EXIT]), 5, "Jump to 5 lands inside"),
+    "jump past end": (JMP(80), 0, "Jump to 80"),
+    "invalid instruction": (bytes([0x7f]), 0, "Invalid instruction"),
+    "truncated instruction": (bytes([0x31, 0x00]), 0, "Truncated instruction"),
+}
+
+
+@pytest.mark.parametrize("case", REJECTED)
+def test_rejects(case):
+    data, pc, message = REJECTED[case]
+    with pytest.raises(VerifyError) as error:
+        verify(data)
+    assert error.value.pc == pc
+    assert str(error.value).startswith(message)
+
+
+def test_overflow_respects_max_depth():
+    assert verify(bytes([PUSHZ, PUSHZ]), max_depth=2)
+    with pytest.raises(VerifyError):
+        verify(bytes([PUSHZ, PUSHZ, PUSHZ]), max_depth=2)
+
+
+def test_depths():
+    # PUSHZ; PUSHZ; ADD; POP 1; JMP 0 loops back at depth 0
+    data = bytes([PUSHZ, PUSHZ, ADD, 0x01]) + JMP(0)
+    assert verify(data) == {0: 0, 1: 1, 2: 2, 3: 1, 4: 0}
+
+
+def test_jump_to_end_halts():
+    assert verify(JMP(3)) == {0: 0}
+
+
+def test_unreachable_code_is_not_checked():
+    assert verify(JMP(4) + bytes([0x7f, EXIT])) == {0: 0, 4: 0}
+
+
+@pytest.mark.parametrize("name", BUNDLED)
+def test_bundled_programs_verify(name):
+    assert verify(bytecode(name))
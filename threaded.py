@@ -0,0 +1,424 @@
+import math
+import operator
+import sys
+
+from time import perf_counter
+
+from program import Program, ProgramError, DEADLINE_CHECK_INTERVAL
+from verifier import VerifyError, verify
+
+# Threaded-code engine: the bytecode is decoded once into a flat list of
+# (handler, arg, next_pc) entries indexed by byte address, so the inner loop
+# never touches the raw bytes or the funct dictionaries again. Every address
+# is decoded (not just the ones reachable from 0) so that jumping into the
+# middle of an instruction behaves exactly as it does in the interpreter.
+# Decoding never fails: malformed instructions become entries that raise the
+# same ProgramError the interpreter would, at the moment they are executed.
+# Programs the verifier proves safe get handlers without the stack checks at
+# every pc it reached, since those checks can never fail for them.
+
+UNARY_FUNCTS = {
+    0x0: lambda x: x + 1,  # INC
+    0x1: lambda x: x - 1,  # DEC
+    0x2: operator.invert,  # NOT
+    0x3: lambda x: int(not x),  # NEG
+    0x4: lambda x: x << 8,  # SHL8
+    0x5: lambda x: x >> 8,  # SHR8
+}
+
+BINARY_FUNCTS = {
+    0x0: operator.add,
+    0x1: operator.sub,
+    0x2: operator.floordiv,
+    0x3: operator.mul,
+    0x4: operator.mod,
+    0x5: operator.and_,
+    0x6: operator.or_,
+    0x7: operator.xor,
+    0x8: operator.gt,
+    0x9: operator.ge,
+    0xa: operator.lt,
+    0xb: operator.le,
+    0xc: operator.eq,
+    0xd: operator.ne,
+    0xe: operator.lshift,
+    0xf: operator.rshift,
+}
+
+FLOAT_FUNCTS = {
+    0x0: math.floor,
+    0x1: math.ceil,
+    0x2: math.sin,
+    0x3: math.cos,
+}
+
+# FDIV lives in the FLOAT group but takes two operands
+FLOAT_BINARY_FUNCTS = {
+    0xf: lambda left, right: float(left) / float(right),
+}
+
+USER_FUNCTS = {
+    0x0: Program.get_length,
+    0x1: Program.get_wall_time,
+    0x2: Program.get_precise_time,
+    0x3: Program.set_pixel,
+    0x4: Program.show,
+    0x5: Program.random_int,
+    0x6: Program.get_pixel,
+    0x7: Program.set_all_pixels,
+    0x8: Program.fill_pixels,
+    0x9: Program.shift_pixels,
+    0xa: Program.rotate_pixels,
+    0xb: Program.blend_pixels,
+    0xc: Program.hue_gradient,
+}
+
+SPECIAL_FUNCTS = {
+    0x9: Program.sleep,
+    0xa: Program.exit,
+    0xc: Program.swap,
+    0xd: Program.dump,
+    0xe: Program.yield_,
+    0xf: Program.twobyte,
+}
+
+
+def op_raise(program, message):
+    raise ProgramError(message)
+
+
+def op_halt(program, arg):
+    program.halt()
+
+
+def op_pop(program, count):
+    if program.sp < count:
+        raise ProgramError(f"Cannot pop beyond stack index.")
+    program.sp -= count
+
+
+def op_push(program, value):
+    sp = program.sp
+    if sp >= program.max_depth:
+        raise ProgramError(f"Stack overflow, maximum depth is {program.max_depth}.")
+    program.stack[sp] = value
+    program.sp = sp + 1
+
+
+def op_peek(program, index):
+    sp = program.sp
+    if not sp > index:
+        raise ProgramError(f"Cannot peek beyond stack index.")
+    if sp >= program.max_depth:
+        raise ProgramError(f"Stack overflow, maximum depth is {program.max_depth}.")
+    stack = program.stack
+    stack[sp] = stack[sp - 1 - index]
+    program.sp = sp + 1
+
+
+def op_jmp(program, target):
+    program.pc = target
+
+
+def op_jz(program, target):
+    if program.sp < 1:
+        raise ProgramError(f"Not enough items in stack.")
+    if program.stack[program.sp - 1] == 0:
+        program.pc = target
+
+
+def op_jnz(program, target):
+    if program.sp < 1:
+        raise ProgramError(f"Not enough items in stack.")
+    if program.stack[program.sp - 1] != 0:
+        program.pc = target
+
+
+def op_truncated_branch(program, when_zero):
+    # conditional jump whose address runs past the end: only taking it fails
+    if program.sp < 1:
+        raise ProgramError(f"Not enough items in stack.")
+    if (program.stack[program.sp - 1] == 0) == when_zero:
+        raise ProgramError("Unexpected EoF, byte requested.")
+    program.pc = len(program.data)
+
+
+def op_unary(program, funct):
+    top = program.sp - 1
+    if top < 0:
+        raise ProgramError(f"Not enough items in stack.")
+    stack = program.stack
+    stack[top] = funct(stack[top])
+
+
+def op_binary(program, funct):
+    top = program.sp - 1
+    if top < 1:
+        raise ProgramError(f"Not enough items in stack.")
+    stack = program.stack
+    stack[top - 1] = funct(stack[top - 1], stack[top])
+    program.sp = top
+
+
+def op_call(program, funct):
+    funct(program)
+
+
+def op_peek_pixel(program, index):
+    sp = program.sp
+    if not sp > index:
+        raise ProgramError(f"Cannot peek beyond stack index.")
+    if sp >= program.max_depth:
+        raise ProgramError(f"Stack overflow, maximum depth is {program.max_depth}.")
+    stack = program.stack
+    r, g, b = program.pixels.get_pixel(stack[sp - 1 - index])
+    stack[sp] = (b << 16) + (g << 8) + r
+    program.sp = sp + 1
+
+
+def op_sleep_jmp(program, arg):
+    delay, target = arg
+    op_push(program, delay)
+    program.sleep()
+    program.pc = target
+
+
+def op_sub_length_jnz(program, target):
+    sp = program.sp
+    if sp < 1:
+        raise ProgramError(f"Cannot peek beyond stack index.")
+    if sp + 1 >= program.max_depth:
+        raise ProgramError(f"Stack overflow, maximum depth is {program.max_depth}.")
+    stack = program.stack
+    difference = stack[sp - 1] - program.pixels.length()
+    stack[sp] = difference
+    program.sp = sp + 1
+    if difference != 0:
+        program.pc = target
+
+
+def op_add_mul_floor(program, arg):
+    add, multiply = arg
+    top = program.sp - 1
+    if top + 1 >= program.max_depth:
+        raise ProgramError(f"Stack overflow, maximum depth is {program.max_depth}.")
+    if top < 0:
+        raise ProgramError(f"Not enough items in stack.")
+    stack = program.stack
+    stack[top] = math.floor((stack[top] + add) * multiply)
+
+
+def op_fallback(program, arg):
+    # truncated fused instruction: let the interpreter fail where it would
+    method, program.pc = arg
+    method(program)
+    program.pc += 1
+
+
+# unchecked handlers for verified programs, whose stack depth at every
+# instruction is known to be in range
+
+def op_pop_unchecked(program, count):
+    program.sp -= count
+
+
+def op_push_unchecked(program, value):
+    sp = program.sp
+    program.stack[sp] = value
+    program.sp = sp + 1
+
+
+def op_peek_unchecked(program, index):
+    sp = program.sp
+    stack = program.stack
+    stack[sp] = stack[sp - 1 - index]
+    program.sp = sp + 1
+
+
+def op_jz_unchecked(program, target):
+    if program.stack[program.sp - 1] == 0:
+        program.pc = target
+
+
+def op_jnz_unchecked(program, target):
+    if program.stack[program.sp - 1] != 0:
+        program.pc = target
+
+
+def op_unary_unchecked(program, funct):
+    stack = program.stack
+    top = program.sp - 1
+    stack[top] = funct(stack[top])
+
+
+def op_binary_unchecked(program, funct):
+    top = program.sp - 1
+    stack = program.stack
+    stack[top - 1] = funct(stack[top - 1], stack[top])
+    program.sp = top
+
+
+def op_peek_pixel_unchecked(program, index):
+    sp = program.sp
+    stack = program.stack
+    r, g, b = program.pixels.get_pixel(stack[sp - 1 - index])
+    stack[sp] = (b << 16) + (g << 8) + r
+    program.sp = sp + 1
+
+
+def op_sub_length_jnz_unchecked(program, target):
+    sp = program.sp
+    stack = program.stack
+    difference = stack[sp - 1] - program.pixels.length()
+    stack[sp] = difference
+    program.sp = sp + 1
+    if difference != 0:
+        program.pc = target
+
+
+def op_add_mul_floor_unchecked(program, arg):
+    add, multiply = arg
+    stack = program.stack
+    top = program.sp - 1
+    stack[top] = math.floor((stack[top] + add) * multiply)
+
+
+UNCHECKED = {
+    op_pop: op_pop_unchecked,
+    op_push: op_push_unchecked,
+    op_peek: op_peek_unchecked,
+    op_jz: op_jz_unchecked,
+    op_jnz: op_jnz_unchecked,
+    op_unary: op_unary_unchecked,
+    op_binary: op_binary_unchecked,
+    op_peek_pixel: op_peek_pixel_unchecked,
+    op_sub_length_jnz: op_sub_length_jnz_unchecked,
+    op_add_mul_floor: op_add_mul_floor_unchecked,
+}
+
+
+def decode_at(data, pc):
+    """Decode the instruction at byte address pc into a (handler, arg, next_pc) entry."""
+    end = len(data)
+    instruction = data[pc]
+    opcode = (instruction & 0xf0) >> 4
+    funct = instruction & 0x0f
+    eof = (op_raise, "Unexpected EoF, byte requested.", end)
+
+    if opcode == 0x0:
+        return (op_pop, funct, pc + 1)
+    if opcode == 0x1:
+        if funct == 0:
+            return (op_push, 0, pc + 1)
+        if pc + 1 >= end:
+            return eof
+        return (op_push, data[pc + 1], pc + 2)
+    if opcode == 0x2:
+        return (op_peek, funct, pc + 1)
+    if opcode == 0x3:
+        if funct == 0:
+            return (op_push, 0, pc + 1)
+        if pc + 4 >= end:
+            return eof
+        return (op_push, int.from_bytes(data[pc + 1 : pc + 5], "little"), pc + 5)
+    if opcode in (0x4, 0x5, 0x6):
+        if pc + 2 >= end:
+            if opcode == 0x4:
+                return eof
+            return (op_truncated_branch, opcode == 0x5, end)
+        # jumps past the end of the program halt it, like the interpreter
+        target = min(data[pc + 1] + (data[pc + 2] << 8), end)
+        handler = {0x4: op_jmp, 0x5: op_jz, 0x6: op_jnz}[opcode]
+        return (handler, target, pc + 3)
+    if opcode == 0x7:
+        if funct not in UNARY_FUNCTS:
+            return (op_raise, f"Invalid unary funct: {funct}", pc + 1)
+        return (op_unary, UNARY_FUNCTS[funct], pc + 1)
+    if opcode == 0x8:
+        return (op_binary, BINARY_FUNCTS[funct], pc + 1)
+    if opcode == 0x9:
+        if funct in FLOAT_BINARY_FUNCTS:
+            return (op_binary, FLOAT_BINARY_FUNCTS[funct], pc + 1)
+        if funct not in FLOAT_FUNCTS:
+            return (op_raise, f"Invalid binary funct: {funct}", pc + 1)
+        return (op_unary, FLOAT_FUNCTS[funct], pc + 1)
+    if opcode == 0xa:
+        return (op_peek_pixel, funct, pc + 1)
+    if opcode in (0xb, 0xc, 0xd):
+        size = {0xb: 3, 0xc: 2, 0xd: 2}[opcode]
+        if pc + size >= end:
+            method = {0xb: Program.SLEEP_JMP, 0xc: Program.SUB_LENGTH_JNZ,
+                      0xd: Program.ADD_MUL_FLOOR}[opcode]
+            return (op_fallback, (method, pc), end)
+        if opcode == 0xb:
+            target = min(data[pc + 2] + (data[pc + 3] << 8), end)
+            return (op_sleep_jmp, (data[pc + 1], target), pc + 4)
+        if opcode == 0xc:
+            target = min(data[pc + 1] + (data[pc + 2] << 8), end)
+            return (op_sub_length_jnz, target, pc + 3)
+        return (op_add_mul_floor, (data[pc + 1], data[pc + 2]), pc + 3)
+    if opcode == 0xe:
+        if funct not in USER_FUNCTS:
+            return (op_raise, f"Invalid user funct: {funct}", pc + 1)
+        return (op_call, USER_FUNCTS[funct], pc + 1)
+    if opcode == 0xf:
+        if funct == 0xb:
+            return (op_raise, f"An error was raised at instruction {pc}", pc + 1)
+        if funct not in SPECIAL_FUNCTS:
+            return (op_raise, f"Invalid special funct: {funct}", pc + 1)
+        return (op_call, SPECIAL_FUNCTS[funct], pc + 1)
+    return (op_raise, f"Invalid opcode: {opcode}", pc + 1)
+
+
+def decode(data, verified=()):
+    """Decode a whole program; the extra trailing entry halts execution.
+
+    Instructions at the pcs in verified get unchecked handlers.
+    """
+    code = [decode_at(data, pc) for pc in range(len(data))]
+    for pc in verified:
+        handler, arg, next_pc = code[pc]
+        code[pc] = (UNCHECKED.get(handler, handler), arg, next_pc)
+    code.append((op_halt, None, len(data)))
+    return code
+
+
+def build_code(data, max_depth):
+    try:
+        verified = verify(data, max_depth)
+    except VerifyError:
+        verified = ()
+    code = decode(data, verified)
+    return code, sys.getsizeof(code) + sum(sys.getsizeof(entry) for entry in code)
+
+
+class ThreadedProgram(Program):
+    """Program that runs pre-decoded threaded code instead of the raw bytes."""
+
+    def load(self, name: str, data: bytes):
+        self.code = self.prepare(
+            data, ("threaded", self.max_depth), lambda data: build_code(data, self.max_depth)
+        )
+        super().load(name, data)
+
+    # execute current instruction
+    def step(self):
+        handler, arg, self.pc = self.code[self.pc]
+        handler(self, arg)
+        if not self.pc < len(self.data):
+            self.halt()
+
+    def burst(self, max_instructions, deadline):
+        code = self.code
+        executed = 0
+        while executed < max_instructions and not self.suspended:
+            burst = min(max_instructions - executed, DEADLINE_CHECK_INTERVAL)
+            for count in range(1, burst + 1):
+                handler, arg, self.pc = code[self.pc]
+                handler(self, arg)
+                if self.suspended:
+                    break
+            executed += count
+            if deadline is not None and perf_counter() >= deadline:
+                break
+        return executed
@@ -0,0 +1,228 @@
+import argparse, json, sys
+
+from assembler import Assembler
+from program import MAX_STACK_DEPTH
+
+# Static verifier: the control-flow graph of a program is walked from pc 0,
+# decoding every reachable instruction once. Since every jump target is an
+# immediate, the stack depth before each reachable instruction can be
+# computed ahead of time; a program whose instructions are all valid, whose
+# jumps all land on an instruction (or exactly on the end, which halts) and
+# whose depths are consistent and within bounds can never fail a stack,
+# funct or operand check at run time. The threaded engine drops those checks
+# for verified programs, the compiler keeps stack slots in locals on the
+# strength of the same analysis, and the server refuses uploads that do not
+# verify.
+
+
+class VerifyError(Exception):
+    def __init__(self, message, pc=None):
+        super().__init__(message)
+        self.pc = pc
+
+
+# mnemonic of every instruction byte; POP, PEEK and PEEK_PIXEL carry their
+# argument in the funct nibble
+MNEMONICS = {opcode: name for name, opcode in Assembler.OPCODES.items()}
+for funct in range(0x10):
+    MNEMONICS[0x00 + funct] = f"POP {funct}"
+    MNEMONICS[0x20 + funct] = f"PEEK {funct}"
+    MNEMONICS[0xa0 + funct] = f"PEEK_PIXEL {funct}"
+
+
+def mnemonic(instruction):
+    return MNEMONICS.get(instruction, hex(instruction))
+
+
+UNARY_FUNCTS = {0x0, 0x1, 0x2, 0x3, 0x4, 0x5}
+FLOAT_FUNCTS = {0x0, 0x1, 0x2, 0x3, 0xf}
+
+# items needed and depth change of the USER and SPECIAL instructions
+CALL_EFFECTS = {
+    0xe0: (0, 1),  # get_length
+    0xe1: (0, 1),  # get_wall_time
+    0xe2: (0, 1),  # get_precise_time
+    0xe3: (2, -1),  # set_pixel
+    0xe4: (0, 0),  # show
+    0xe5: (0, 1),  # random_int
+    0xe6: (1, 0),  # get_pixel
+    0xe7: (1, -1),  # set_all_pixels
+    0xe8: (3, -3),  # fill_pixels
+    0xe9: (1, -1),  # shift_pixels
+    0xea: (1, -1),  # rotate_pixels
+    0xeb: (2, -2),  # blend_pixels
+    0xec: (2, -2),  # hue_gradient
+    0xf9: (1, -1),  # sleep
+    0xfa: (0, 0),  # exit
+    0xfb: (0, 0),  # error
+    0xfc: (0, 0),  # swap
+    0xfd: (0, 0),  # dump
+    0xfe: (0, 0),  # yield
+    0xff: (0, 0),  # two_byte
+}
+
+# items fused instructions push and pop again, beyond their depth change
+TRANSIENT = {0xb: 1, 0xc: 1, 0xd: 1}
+
+
+def decode_instruction(data, pc):
+    """Return (instruction, arg, next_pc) for the instruction at pc."""
+    end = len(data)
+    instruction = data[pc]
+    opcode = (instruction & 0xf0) >> 4
+    funct = instruction & 0x0f
+    size = 0
+    if opcode in (0x1, 0x3) and funct != 0:
+        size = 1 if opcode == 0x1 else 4
+    elif opcode in (0x4, 0x5, 0x6, 0xc, 0xd):
+        size = 2
+    elif opcode == 0xb:
+        size = 3
+    if pc + size >= end:
+        raise VerifyError(f"Truncated instruction at {pc} ({mnemonic(instruction)})", pc)
+    if opcode == 0xb:
+        arg = (data[pc + 1], data[pc + 2] + (data[pc + 3] << 8))  # delay, target
+    elif opcode == 0xd:
+        arg = (data[pc + 1], data[pc + 2])  # addend, factor
+    elif size:
+        arg = int.from_bytes(data[pc + 1 : pc + 1 + size], "little")
+    else:
+        arg = funct
+
+    valid = (
+        opcode in (0x0, 0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x8, 0xa, 0xb, 0xc, 0xd)
+        or (opcode == 0x7 and funct in UNARY_FUNCTS)
+        or (opcode == 0x9 and funct in FLOAT_FUNCTS)
+        or instruction in CALL_EFFECTS
+    )
+    if not valid:
+        raise VerifyError(f"Invalid instruction {hex(instruction)} at {pc}", pc)
+    return instruction, arg, pc + 1 + size
+
+
+def stack_effect(instruction, arg):
+    """Return (items needed, depth change) for a decoded instruction."""
+    opcode = (instruction & 0xf0) >> 4
+    if opcode == 0x0:
+        return arg, -arg
+    if opcode in (0x1, 0x3):
+        return 0, 1
+    if opcode in (0x2, 0xa):
+        return arg + 1, 1
+    if opcode in (0x4, 0xb):
+        return 0, 0
+    if opcode in (0x5, 0x6, 0x7):
+        return 1, 0
+    if opcode == 0x8 or instruction == 0x9f:
+        return 2, -1
+    if opcode in (0x9, 0xd):
+        return 1, 0
+    if opcode == 0xc:
+        return 1, 1
+    return CALL_EFFECTS[instruction]
+
+
+# addresses the jump of a decoded instruction can go to, if it has one
+def jump_target(instruction, arg):
+    opcode = (instruction & 0xf0) >> 4
+    if opcode in (0x4, 0x5, 0x6, 0xc):
+        return arg
+    if opcode == 0xb:
+        return arg[1]
+    return None
+
+
+def successors(instruction, arg, next_pc):
+    opcode = (instruction & 0xf0) >> 4
+    if opcode in (0x4, 0xb):
+        return [jump_target(instruction, arg)]
+    if opcode in (0x5, 0x6, 0xc):
+        return [arg, next_pc]
+    if instruction in (0xfa, 0xfb):
+        return []
+    return [next_pc]
+
+
+def analyse(data, max_depth=MAX_STACK_DEPTH):
+    """Compute the stack depth before every reachable instruction.
+
+    Returns (instructions, depths), mapping each reachable pc to its decoded
+    (instruction, arg, next_pc) and to the depth before it. Jumps at or past
+    the end are taken to halt, and jumps into the middle of an instruction
+    are followed like any other; verify() rules both out as well.
+    """
+    end = len(data)
+    instructions = {}
+    depths = {0: 0} if end else {}
+    pending = list(depths)
+    while pending:
+        pc = pending.pop()
+        instruction, arg, next_pc = decode_instruction(data, pc)
+        instructions[pc] = (instruction, arg, next_pc)
+        needed, delta = stack_effect(instruction, arg)
+        depth = depths[pc]
+        name = mnemonic(instruction)
+        if depth < needed:
+            raise VerifyError(
+                f"Possible stack underflow at {pc} ({name}): "
+                f"stack depth {depth}, needs {needed}", pc)
+        depth += delta
+        peak = depth + TRANSIENT.get(instruction >> 4, 0)
+        if peak > max_depth:
+            raise VerifyError(
+                f"Possible stack overflow at {pc} ({name}): "
+                f"depth {peak}, maximum is {max_depth}", pc)
+        for successor in successors(instruction, arg, next_pc):
+            if successor >= end:
+                continue
+            if successor not in depths:
+                depths[successor] = depth
+                pending.append(successor)
+            elif depths[successor] != depth:
+                raise VerifyError(
+                    f"Inconsistent stack depth at {successor}: "
+                    f"{depths[successor]} or {depth}", successor)
+    return instructions, depths
+
+
+def verify(data, max_depth=MAX_STACK_DEPTH):
+    """Prove data safe to run unchecked, returning the depth at every reachable pc.
+
+    Raises VerifyError, naming the pc and instruction at fault, if any
+    reachable instruction is invalid or truncated, a jump goes past the end
+    or into the middle of an instruction, or the stack could underflow,
+    overflow max_depth or have different depths where paths join.
+    """
+    end = len(data)
+    instructions, depths = analyse(data, max_depth)
+    pcs = sorted(instructions)
+    for pc, following in zip(pcs, pcs[1:]):
+        if instructions[pc][2] > following:
+            raise VerifyError(
+                f"Jump to {following} lands inside the instruction at {pc} "
+                f"({mnemonic(instructions[pc][0])})", following)
+    for pc, (instruction, arg, next_pc) in instructions.items():
+        target = jump_target(instruction, arg)
+        if target is not None and target > end:
+            raise VerifyError(
+                f"Jump to {target} at {pc} ({mnemonic(instruction)}) "
+                f"is past the end of the program ({end} bytes)", pc)
+    return depths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", default=None, metavar="file", type=str)
+    args = parser.parse_args()
+
+    with open(args.infile, "rb") as binary:
+        data = binary.read()
+    try:
+        depths = verify(data)
+    except VerifyError as error:
+        print(f"{args.infile}: {error}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps({
+        "instructions": len(depths),
+        "max_depth": max(depths.values(), default=0),
+    }, indent=2))